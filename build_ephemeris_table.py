@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+Build the precomputed ephemeris table used with EPHEMERIS_MODE = "table".
+
+The table holds geocentric sun and moon positions and the galactic pole direction every
+EPHEMERIS_TABLE_STEP_S for a range of years, as float32 rows in one binary file that the
+service memory-maps at startup. Nothing in it depends on the observer, so one file serves
+every site. Years are computed in parallel; afterwards the table is checked against a full
+astropy transform at random times.
+
+Usage:
+    python3 build_ephemeris_table.py --start-year 2015 --end-year 2035
+    python3 build_ephemeris_table.py --start-year 2024 --end-year 2026 --output /tmp/ephemeris_table.bin
+"""
+
+import argparse
+import sys
+import os
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import numpy as np
+import logging
+from astropy.time import Time
+from astropy.coordinates import EarthLocation, AltAz, SkyCoord
+from astropy import units as u
+
+# Import ephemeris functions from main service
+sys.path.insert(0, '/Users/morten/sqm_process2/sqm_processing')
+try:
+    from my_sqm_service import (
+        EPHEMERIS_TABLE_PATH, EPHEMERIS_TABLE_STEP_S, EphemerisTable,
+        compute_ephemeris_table_rows, write_ephemeris_table, table_ephemeris,
+        _exact_grid_vectors, _grid_angles,
+    )
+except ImportError as e:
+    print(f"ERROR: Could not import from my_sqm_service: {e}")
+    sys.exit(1)
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def year_seconds(year, start_s, step_s):
+    """Table times (unix seconds) that fall in a year, on the grid start_s + k * step_s"""
+    first = (datetime(year, 1, 1) - EPOCH).total_seconds()
+    end = (datetime(year + 1, 1, 1) - EPOCH).total_seconds()
+    k0 = int(np.ceil((first - start_s) / step_s))
+    k1 = int(np.ceil((end - start_s) / step_s))
+    return start_s + step_s * np.arange(k0, k1, dtype=float)
+
+
+def calculate_year(year, start_s, step_s):
+    """Table rows for one year, runs in a worker process"""
+    return compute_ephemeris_table_rows(year_seconds(year, start_s, step_s))
+
+
+def build(start_year, end_year, step_s=EPHEMERIS_TABLE_STEP_S, output=EPHEMERIS_TABLE_PATH, workers=None):
+    """Compute and write the table for start_year to end_year (inclusive), returns the row count"""
+    # one year of padding on both sides, the spline needs rows around the first and last time
+    first_year, last_year = start_year - 1, end_year + 1
+    start_s = int((datetime(first_year, 1, 1) - EPOCH).total_seconds())
+    years = list(range(first_year, last_year + 1))
+    workers = max(1, min(workers or os.cpu_count() or 1, len(years)))
+
+    started = time.time()
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+        parts = list(executor.map(calculate_year, years, [start_s] * len(years), [step_s] * len(years)))
+    rows = np.concatenate(parts)
+    logger.info(f"Computed {len(rows)} rows for {first_year}-{last_year} in {time.time() - started:.0f}s")
+
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    write_ephemeris_table(output, start_s, step_s, rows)
+    logger.info(f"Wrote {output}, {os.path.getsize(output) / 1e6:.1f} MB")
+    return len(rows)
+
+
+def astropy_zenith_galactic_latitude(times, location):
+    """Galactic latitude b (deg) of the zenith through astropy's AltAz -> galactic transform"""
+    n = len(times)
+    zen_altaz = AltAz(obstime=times, location=location, alt=np.full(n, 90.0)*u.deg, az=np.zeros(n)*u.deg)  # az arbitrary at zenith
+    return np.atleast_1d(SkyCoord(zen_altaz).transform_to('galactic').b.deg)
+
+
+def check_ephemeris_table(table, samples=200, sites=((56.04, 10.87), (-33.9, 18.4), (78.2, 15.6))):
+    """
+    Compare table_ephemeris with a full astropy transform at random times within the table.
+    Returns the maximum absolute sun altitude, moon altitude and |b| differences (deg).
+    """
+    rng = np.random.default_rng(0)
+    x = np.sort(rng.uniform(table.start_s + 3 * table.step_s, table.end_s - 4 * table.step_s, samples))
+    times = Time(x, format='unix', scale='utc')
+    errors = np.zeros(3)
+    for lat, lon in sites:
+        location = EarthLocation(lat=lat*u.deg, lon=lon*u.deg)
+        exact = _grid_angles(_exact_grid_vectors(x, location))
+        exact[2] = np.abs(astropy_zenith_galactic_latitude(times, location))
+        errors = np.maximum(errors, np.abs(np.array(table_ephemeris(times, location, table)) - exact).max(axis=1))
+    return {"sun_alt": errors[0], "moon_alt": errors[1], "zenith_b": errors[2]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the precomputed ephemeris table')
+    parser.add_argument('--start-year', type=int, required=True, help='First year covered')
+    parser.add_argument('--end-year', type=int, required=True, help='Last year covered')
+    parser.add_argument('--step', type=int, default=EPHEMERIS_TABLE_STEP_S,
+                        help=f'Seconds between rows (default: {EPHEMERIS_TABLE_STEP_S})')
+    parser.add_argument('--output', default=EPHEMERIS_TABLE_PATH, help='Table file to write')
+    parser.add_argument('--workers', type=int, help='Worker processes (default: number of CPUs)')
+    args = parser.parse_args()
+
+    if args.end_year < args.start_year:
+        print("Error: --end-year is before --start-year")
+        sys.exit(1)
+
+    build(args.start_year, args.end_year, args.step, args.output, args.workers)
+    errors = check_ephemeris_table(EphemerisTable(args.output))
+    print("Max error vs astropy (deg): " + ", ".join(f"{k} {v:.6f}" for k, v in errors.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,19 @@
 from fastapi import FastAPI, UploadFile, File, Query, APIRouter, Form
-from fastapi.responses import StreamingResponse, JSONResponse, PlainTextResponse, HTMLResponse
+from fastapi.responses import StreamingResponse, JSONResponse, PlainTextResponse, HTMLResponse, FileResponse
 from astropy.time import Time
-from astropy.coordinates import get_sun, get_body, EarthLocation, AltAz, SkyCoord #get_moon, 
+from astropy.coordinates import get_sun, get_body, EarthLocation, AltAz, SkyCoord, CIRS #get_moon, 
 from astropy import units as u
-from datetime import datetime
+import erfa
+from datetime import datetime, timedelta
 import numpy as np
-from collections import deque
+from collections import deque, OrderedDict
 import io
 import re
+import csv
 import os
 import traceback
 from collections import deque
-import matplotlib.pyplot as plt
-from scipy.interpolate import make_interp_spline, interp1d
+from scipy.interpolate import make_interp_spline, interp1d, CubicSpline
 
 #import astropy.visualization
 import pandas as pd
@@ -23,13 +24,26 @@ import random
 import math
 
 import logging
+import time
+import uuid
+import asyncio
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import mysql.connector
+import sqlite3
 from mysql.connector import Error
+from mysql.connector import pooling
+from mysql.connector.errors import PoolError
+from contextlib import contextmanager
 import json
-
-import matplotlib
-matplotlib.rcParams['font.family'] = 'DejaVu Sans'  # or 'Liberation Sans', 'Arial', etc.
-matplotlib.rcParams['font.sans-serif'] = ['DejaVu Sans']
+import html
+import struct
+import gzip
+import hashlib
+import shutil
+import importlib.util
 
 # startup:
 # source /srv/www/d9.pihl.net/public_html/sqm_processing/venv/bin/activate
@@ -50,6 +64,15 @@ app = FastAPI(title="SQM Processing Service")
 async def startup_event():
     """Initialize database cache on application startup"""
     init_cache_db()
+    expire_job_status()
+    if EPHEMERIS_MODE == "table":
+        get_ephemeris_table()
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Stop the worker processes"""
+    shutdown_process_pool()
 
 UPLOAD_DIR = "/srv/www/d9.pihl.net/public_html/sqm_processing/uploads"
 os.makedirs(UPLOAD_DIR, exist_ok=True)
@@ -57,6 +80,12 @@ os.makedirs(UPLOAD_DIR, exist_ok=True)
 DOWNLOAD_DIR = "/srv/www/d9.pihl.net/public_html/sqm_processing/downloads"
 os.makedirs(DOWNLOAD_DIR, exist_ok=True)
 
+JOBS_DIR = "/srv/www/d9.pihl.net/public_html/sqm_processing/jobs"
+os.makedirs(JOBS_DIR, exist_ok=True)
+
+RESULT_CACHE_DIR = os.path.join(DOWNLOAD_DIR, "results")  # one directory per processed upload
+os.makedirs(RESULT_CACHE_DIR, exist_ok=True)
+
 # ---------------- CONFIGURATION DEFAULTS ----------------
 DEFAULT_ROLL_DURATION_MIN = 15
 DEFAULT_STDEV_THRESHOLD = 0.05
@@ -75,14 +104,55 @@ BASE_MW_SB = 20.5                  # mag/arcsec^2 at zenith (tune to your site)
 BASE_MW_SB_AT_PLANE = 20.0         # mag/arcsec² for zenith lying exactly on galactic plane
 PLANE_TO_POLE_FADE = 2.5           # additional mag from b=0 -> |b|=90 (tune to site)
 EXTINCTION_COEFF = 0.15            # mag per airmass (typical site value)
+MW_MODEL = "zenith"                # "zenith" (zenith |b|, airmass 1) or "beam" (averaged over the SQM beam with Kasten airmass)
+MW_BEAM_FWHM_DEG = 20.0            # SQM-L beam; about 84 for the SQM without lens
+MW_BEAM_RINGS = 8                  # beam grid: zenith angle rings ...
+MW_BEAM_AZIMUTHS = 16              # ... times azimuths per ring
+MW_BEAM_STEP_S = 300               # beam model evaluated on this grid and interpolated (< 0.001 mag), 0 = every timestamp
+MW_BEAM_CHUNK = 20000              # timestamps per NumPy evaluation of the beam model
 MW_SB_THRESHOLD = 21            # max mag/arcsec^2 to consider "Milky Way visible"
 
 LIMIT_SERIALS = 0
+
+# Ephemeris
+EPHEMERIS_MODE = "interpolated"    # "interpolated" (adaptive cubic grid per site), "sky_cache" (shared cached sun/moon positions) or "table" (EPHEMERIS_TABLE_PATH)
+EPHEMERIS_MAX_ERROR_DEG = 0.01     # max sun/moon altitude and zenith |b| error of the interpolated grid
+EPHEMERIS_MIN_GRID_STEP_S = 60     # give up refining below this grid step and compute exactly
+SIDEREAL_DAY_S = 86164.0905
+EPHEMERIS_TABLE_PATH = "/srv/www/d9.pihl.net/public_html/sqm_processing/cache/ephemeris_table.bin"  # made by build_ephemeris_table.py
+EPHEMERIS_TABLE_STEP_S = 1200      # row spacing of a newly built table
+
+READ_CHUNK_ROWS = 100000           # data lines per chunk when reading .dat files
+FILTER_ENGINE = "vectorized"       # "vectorized" or "loop" (line by line reference)
+OUTPUT_FORMAT = "csv"              # processed file: "csv", "csv.gz" or "parquet" (needs pyarrow)
+OUTPUT_GZIP_LEVEL = 6              # csv.gz compression level, 9 is much slower for a few % smaller files
+REPORT_MAX_EVENTS = 50             # notable lines (unreadable values, bad timestamps) listed in the report
+REPORT_MAX_INTERVALS = 10          # most common measurement intervals listed in the report
+
+# Result cache
+RESULT_CACHE_ENABLED = True        # serve identical uploads with identical parameters from RESULT_CACHE_DIR
+RESULT_CACHE_MAX_BYTES = 2 * 1024**3  # least recently used results are removed beyond this
+RESULT_CACHE_VERSION = 1           # bump when a code change alters processed results
+
+# Worker pool
+PROCESS_POOL_WORKERS = 2           # uploads processed in parallel
+PROCESS_QUEUE_LIMIT = 4            # uploads waiting for a worker before answering 503
+PROCESS_RETRY_AFTER_S = 30         # Retry-After sent with 503
+JOB_PROGRESS_INTERVAL_S = 1.0      # min seconds between job progress updates within a phase
+JOB_EVENTS_POLL_S = 0.5            # /jobs/<id>/events checks the job state this often
+JOB_EVENTS_KEEPALIVE_S = 15        # comment line sent when nothing changed, keeps proxies from timing out
+JOB_STATUS_MAX_AGE_S = 7 * 24 * 3600  # job state files not updated for this long are removed
 # --------------------------------------------------------
 
-# MySQL Caching Configuration
+# Caching Configuration
 CACHE_ENABLED = True  # Set to False to disable caching
+CACHE_BACKEND = "mysql"  # "mysql" (DB_CONFIG) or "sqlite" (SQLITE_CACHE_PATH, no server needed)
+SQLITE_CACHE_PATH = "/srv/www/d9.pihl.net/public_html/sqm_processing/cache/sqm_cache.sqlite"
 CACHE_TIME_BUCKET_MIN = 20  # Cache granularity: 20 minutes
+CACHE_POOL_SIZE = 4  # MySQL connections shared by the threads of one process
+CACHE_RETRY_INTERVAL_S = 60  # while MySQL is unreachable, try to connect again after this many seconds
+CACHE_WRITE_BATCH_SIZE = 1000  # buffered cache rows written per multi-row insert
+CACHE_LRU_MAX_ENTRIES = 200000  # in-memory buckets in front of MySQL, about 470 bytes each (~95 MB per process)
 
 DB_CONFIG = {
     'host': 'localhost',
@@ -99,8 +169,6 @@ serial_number = None
 
 ALLOWED_SERIALS = "2586,2588,6849,3387,6362,6860,6852,6859,6851,6857,6854,LANGELAND:,7118,7110,7115,7116,7122,7108,7109,7107,7113"
 
-conn = mysql.connector.connect(**DB_CONFIG)
-
 def scale_series(series, new_min, new_max):
     arr = np.array(series)
     scaled = (arr - arr.min()) / (arr.max() - arr.min())  # scale to 0–1
@@ -108,11 +176,12 @@ def scale_series(series, new_min, new_max):
     
     
 def airmass_kasten(z_deg):
-    """Kasten & Young (1989) airmass approximation. z_deg = zenith angle in degrees."""
-    if z_deg >= 90:
-        return float('inf')
-    z = z_deg
-    return 1.0 / (math.cos(math.radians(z)) + 0.50572 * (96.07995 - z) ** -1.6364)
+    """Kasten & Young (1989) airmass approximation. z_deg = zenith angle in degrees (scalar or array)."""
+    z = np.asarray(z_deg, dtype=float)
+    below = z >= 90
+    zc = np.where(below, 0.0, z)
+    airmass = np.where(below, np.inf, 1.0 / (np.cos(np.radians(zc)) + 0.50572 * (96.07995 - zc) ** -1.6364))
+    return float(airmass) if airmass.ndim == 0 else airmass
 
 def estimate_mw_surface_brightness(airmass, base_sb=20.5, extinction_coeff=0.15):
     """
@@ -127,157 +196,1144 @@ def estimate_mw_surface_brightness(airmass, base_sb=20.5, extinction_coeff=0.15)
 
 
 # ==================== CACHING FUNCTIONS ====================
+# The cache tables live in a backend selected by CACHE_BACKEND: "mysql" (DB_CONFIG) or
+# "sqlite" (a local file, no server needed). Both have the same schema and semantics.
+#
+# sky_cache holds geocentric apparent (CIRS) RA/Dec and distance of sun and moon per
+# CACHE_TIME_BUCKET_MIN step. These don't depend on the observer, so one table serves
+# every site; process_stream derives the altitudes for a site from it (site_altitudes).
+# It replaced the per-location celestial_cache table, which is no longer created or read.
+#
+# The functions below are backend independent; when the backend is unavailable they
+# behave as if caching was disabled.
+
+CACHE_ERRORS = (Error, sqlite3.Error)
+SKY_COLUMNS = ("time_bucket", "sun_ra", "sun_dec", "sun_dist_km", "moon_ra", "moon_dec", "moon_dist_km")
+
+# MySQL connections come from a pool that is created on first use, so importing this
+# module never needs MySQL. When MySQL is unreachable, creating the pool or getting a
+# connection from it, the cache is skipped until CACHE_RETRY_INTERVAL_S has passed.
+
+_cache_pool = None
+_cache_pool_failed_at = None
+_cache_pool_lock = threading.Lock()
+
+
+def get_cache_pool():
+    """Return the cache connection pool, None while MySQL is unreachable"""
+    global _cache_pool, _cache_pool_failed_at
+    if _cache_pool_failed_at is not None and time.time() - _cache_pool_failed_at < CACHE_RETRY_INTERVAL_S:
+        return None
+    if _cache_pool is not None:
+        return _cache_pool
+    with _cache_pool_lock:
+        if _cache_pool is not None:
+            return _cache_pool
+        try:
+            _cache_pool = pooling.MySQLConnectionPool(pool_name=f"sqm_cache_{os.getpid()}",
+                                                      pool_size=CACHE_POOL_SIZE, **DB_CONFIG)
+            _cache_pool_failed_at = None
+            logging.info(f"Cache connection pool created, {CACHE_POOL_SIZE} connections")
+        except Error as e:
+            _cache_pool_failed_at = time.time()
+            logging.warning(f"Cache DB unreachable: {e}. Caching disabled, retry in {CACHE_RETRY_INTERVAL_S}s")
+        return _cache_pool
+
+
+@contextmanager
+def cache_connection():
+    """
+    Borrow a connection from the pool, checked with a ping that reconnects after MySQL's
+    wait_timeout. Yields None when no healthy connection is available; the caller then
+    treats the cache as disabled. The connection goes back to the pool afterwards.
+    """
+    global _cache_pool_failed_at
+    pool = get_cache_pool()
+    if pool is None:
+        yield None
+        return
+    try:
+        connection = pool.get_connection()
+    except PoolError as e:
+        # all connections busy, don't wait for one
+        logging.debug(f"No free cache connection: {e}")
+        yield None
+        return
+    except Error as e:
+        logging.warning(f"Cache connection failed: {e}. Caching disabled, retry in {CACHE_RETRY_INTERVAL_S}s")
+        _cache_pool_failed_at = time.time()
+        yield None
+        return
+    try:
+        try:
+            connection.ping(reconnect=True, attempts=2, delay=0)
+        except Error as e:
+            logging.warning(f"Cache connection lost: {e}. Caching disabled, retry in {CACHE_RETRY_INTERVAL_S}s")
+            _cache_pool_failed_at = time.time()
+            yield None
+            return
+        _cache_pool_failed_at = None
+        yield connection
+    finally:
+        try:
+            connection.close()   # returns it to the pool
+        except Error:
+            pass
+
+
+class MySQLCacheBackend:
+    """sky_cache table in MySQL, connections from the pool above"""
+
+    name = "mysql"
+
+    def init(self):
+        with cache_connection() as conn:
+            if conn is None:
+                return False
+            cursor = conn.cursor()
+
+            # Create database if it doesn't exist
+            cursor.execute(f"CREATE DATABASE IF NOT EXISTS {DB_CONFIG['database']}")
+            cursor.execute(f"USE {DB_CONFIG['database']}")
+
+            cursor.execute("""
+            CREATE TABLE IF NOT EXISTS sky_cache (
+                time_bucket DATETIME NOT NULL PRIMARY KEY,
+                sun_ra DOUBLE,
+                sun_dec DOUBLE,
+                sun_dist_km DOUBLE,
+                moon_ra DOUBLE,
+                moon_dec DOUBLE,
+                moon_dist_km DOUBLE,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+            """)
+            conn.commit()
+            cursor.close()
+        return True
 
-def round_location(lat, lon):
+    def fetch_sky_range(self, first_bucket, last_bucket):
+        """sky_cache rows (dicts) between two buckets, inclusive"""
+        with cache_connection() as conn:
+            if conn is None:
+                return []
+            cursor = conn.cursor(dictionary=True)
+            cursor.execute(f"""
+            SELECT {", ".join(SKY_COLUMNS)}
+            FROM sky_cache
+            WHERE time_bucket BETWEEN %s AND %s
+            """, (first_bucket, last_bucket))
+            rows = cursor.fetchall()
+            cursor.close()
+        return rows
+
+    def store_sky(self, rows):
+        """Insert or update sky_cache rows (tuples in SKY_COLUMNS order), one commit"""
+        with cache_connection() as conn:
+            if conn is None:
+                return False
+            cursor = conn.cursor()
+            placeholders = ", ".join(["(%s, %s, %s, %s, %s, %s, %s)"] * len(rows))
+            updates = ", ".join(f"{c} = VALUES({c})" for c in SKY_COLUMNS[1:])
+            query = f"""
+            INSERT INTO sky_cache ({", ".join(SKY_COLUMNS)})
+            VALUES {placeholders}
+            ON DUPLICATE KEY UPDATE {updates}
+            """
+            try:
+                cursor.execute(query, [value for row in rows for value in row])
+                conn.commit()
+            except Error:
+                conn.rollback()
+                raise
+            finally:
+                cursor.close()
+        return True
+
+
+class SQLiteCacheBackend:
     """
-    Round latitude and longitude for cache key optimization.
-    Latitude: rounded to nearest whole degree
-    Longitude: rounded to nearest 0.5 degree
-    
-    This reduces cache fragmentation while maintaining sufficient precision
-    for astronomical calculations (input precision is 0.001 degree).
+    sky_cache table in a local SQLite file (SQLITE_CACHE_PATH) in WAL mode, so
+    readers in several worker processes don't block the writer. One connection per
+    thread. time_bucket is stored as 'YYYY-MM-DD HH:MM:SS' text, which sorts like time.
     """
-    if lat is None or lon is None:
-        return None, None
-    
-    # Round latitude to nearest 1.0 degree
-    lat_rounded = round(float(lat), 0)
-    
-    # Round longitude to nearest 0.5 degree
-    lon_rounded = round(float(lon) * 2) / 2
-    
-    return lat_rounded, lon_rounded
+
+    name = "sqlite"
+
+    def __init__(self, path=None):
+        self.path = path or SQLITE_CACHE_PATH
+        self.local = threading.local()
+
+    def connection(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("""
+            CREATE TABLE IF NOT EXISTS sky_cache (
+                time_bucket TEXT NOT NULL PRIMARY KEY,
+                sun_ra REAL,
+                sun_dec REAL,
+                sun_dist_km REAL,
+                moon_ra REAL,
+                moon_dec REAL,
+                moon_dist_km REAL,
+                created_at TEXT DEFAULT CURRENT_TIMESTAMP
+            )
+            """)
+            conn.commit()
+            self.local.conn = conn
+        return conn
+
+    def init(self):
+        self.connection()
+        return True
+
+    @staticmethod
+    def _bucket_text(time_bucket):
+        return time_bucket.strftime("%Y-%m-%d %H:%M:%S")
+
+    def fetch_sky_range(self, first_bucket, last_bucket):
+        rows = self.connection().execute(f"""
+            SELECT {", ".join(SKY_COLUMNS)}
+            FROM sky_cache
+            WHERE time_bucket BETWEEN ? AND ?
+            """, (self._bucket_text(first_bucket), self._bucket_text(last_bucket))).fetchall()
+        result = []
+        for row in rows:
+            row = dict(row)
+            row['time_bucket'] = datetime.strptime(row['time_bucket'], "%Y-%m-%d %H:%M:%S")
+            result.append(row)
+        return result
+
+    def store_sky(self, rows):
+        conn = self.connection()
+        updates = ", ".join(f"{c} = excluded.{c}" for c in SKY_COLUMNS[1:])
+        try:
+            conn.executemany(f"""
+                INSERT INTO sky_cache ({", ".join(SKY_COLUMNS)})
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (time_bucket) DO UPDATE SET {updates}
+                """, [(self._bucket_text(r[0]),) + tuple(float(v) for v in r[1:]) for r in rows])
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+        return True
+
+
+CACHE_BACKENDS = {
+    "mysql": MySQLCacheBackend,
+    "sqlite": SQLiteCacheBackend,
+}
+
+_cache_backend = None
+
+
+def get_cache_backend():
+    """The configured cache backend, created on first use"""
+    global _cache_backend
+    if _cache_backend is None or _cache_backend.name != CACHE_BACKEND:
+        _cache_backend = CACHE_BACKENDS[CACHE_BACKEND]()
+    return _cache_backend
+
+
+class LRUCache:
+    """
+    Bounded in-memory cache of sky_cache rows keyed on time_bucket, kept in front of the
+    cache backend. Least recently used entries are evicted beyond
+    max_entries. Thread safe; counts hits, misses and evictions.
+    """
+
+    def __init__(self, max_entries=CACHE_LRU_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            row = self.entries.get(key)
+            if row is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return row
+
+    def put(self, key, row):
+        if self.max_entries <= 0:
+            return
+        with self.lock:
+            self.entries[key] = row
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "max_entries": self.max_entries,
+                    "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+
+sky_lru = LRUCache()         # sky_cache rows, keyed on time_bucket
 
 
 def init_cache_db():
-    """Initialize MySQL database for caching celestial calculations"""
+    """Initialize the cache table of the configured backend"""
     try:
-        # conn = mysql.connector.connect(
-        #     host=DB_CONFIG['host'],
-        #     user=DB_CONFIG['user'],
-        #     password=DB_CONFIG['password']
-        # )
-        cursor = conn.cursor()
-        
-        # Create database if it doesn't exist
-        cursor.execute(f"CREATE DATABASE IF NOT EXISTS {DB_CONFIG['database']}")
-        cursor.execute(f"USE {DB_CONFIG['database']}")
-        
-        # Create cache table
-        create_table_query = """
-        CREATE TABLE IF NOT EXISTS celestial_cache (
-            id INT AUTO_INCREMENT PRIMARY KEY,
-            lat DECIMAL(10, 6) NOT NULL,
-            lon DECIMAL(10, 6) NOT NULL,
-            time_bucket DATETIME NOT NULL,
-            sun_alt FLOAT,
-            moon_alt FLOAT,
-            mw_brightness FLOAT,
-            milky_way_visible BOOLEAN,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            UNIQUE KEY unique_calc (lat, lon, time_bucket)
-        )
-        """
-        cursor.execute(create_table_query)
-        conn.commit()
-        cursor.close()
-        # conn.close()
-        logging.info("Cache database initialized successfully")
+        if not get_cache_backend().init():
+            logging.warning("Cache DB not available. Caching disabled.")
+            return False
+        logging.info(f"Cache database initialized successfully ({CACHE_BACKEND})")
         return True
-    except Error as e:
+    except CACHE_ERRORS as e:
         logging.warning(f"Cache DB initialization failed: {e}. Caching disabled.")
         return False
 
 
-def get_time_bucket(t_astropy, bucket_minutes=CACHE_TIME_BUCKET_MIN):
-    """Round time to nearest bucket for caching"""
-    dt = t_astropy.datetime
-    bucket_seconds = bucket_minutes * 60
+def get_sky_cache_range(first_bucket, last_bucket):
+    """
+    Retrieve all sky_cache rows with time_bucket between first_bucket and last_bucket
+    (datetimes, inclusive) in one range query on the primary key.
+    Returns {time_bucket: row}, empty when the cache is disabled or unavailable.
+    """
+    if not CACHE_ENABLED:
+        return {}
+
+    try:
+        rows = get_cache_backend().fetch_sky_range(first_bucket, last_bucket)
+        logging.debug(f"Sky cache range {first_bucket} - {last_bucket}: {len(rows)} rows")
+        result = {}
+        for row in rows:
+            time_bucket = row.pop('time_bucket')
+            sky_lru.put(time_bucket, row)
+            result[time_bucket] = row
+        return result
+    except CACHE_ERRORS as e:
+        logging.warning(f"Sky cache range retrieval failed: {e}")
+        return {}
+
+
+def get_sky_cache(time_buckets):
+    """
+    sky_cache rows for a list of time buckets. Buckets in the in-memory LRU are served
+    from there, the rest with one range query over their span. Returns {time_bucket: row}.
+    """
+    if not CACHE_ENABLED or not time_buckets:
+        return {}
+
+    result = {}
+    missing = []
+    for time_bucket in time_buckets:
+        row = sky_lru.get(time_bucket)
+        if row is None:
+            missing.append(time_bucket)
+        else:
+            result[time_bucket] = row
+    if missing:
+        rows = get_sky_cache_range(min(missing), max(missing))
+        for time_bucket in missing:
+            if time_bucket in rows:
+                result[time_bucket] = rows[time_bucket]
+    return result
+
+
+class CacheWriteBuffer:
+    """
+    Write-behind buffer for sky_cache rows. add() collects rows, flush() stores them with
+    one multi-row insert and a single commit; the buffer flushes by itself once
+    CACHE_WRITE_BATCH_SIZE rows are waiting. A failed flush is logged and the rows are
+    dropped, the cache is only an optimization and the caller's results are not affected.
+    """
+
+    def __init__(self, batch_size=CACHE_WRITE_BATCH_SIZE):
+        self.batch_size = batch_size
+        self.rows = []
+        self.written = 0
+
+    def add(self, time_bucket, sun_ra, sun_dec, sun_dist_km, moon_ra, moon_dec, moon_dist_km):
+        if not CACHE_ENABLED:
+            return
+        row = (time_bucket, sun_ra, sun_dec, sun_dist_km, moon_ra, moon_dec, moon_dist_km)
+        # the LRU serves the row at once, also when the database write fails later
+        sky_lru.put(time_bucket, dict(zip(SKY_COLUMNS[1:], row[1:])))
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered rows, returns the number of rows stored"""
+        rows, self.rows = self.rows, []
+        if not rows:
+            return 0
+        try:
+            if not get_cache_backend().store_sky(rows):
+                logging.debug(f"Cache not available, {len(rows)} rows not stored")
+                return 0
+            self.written += len(rows)
+            logging.debug(f"Cache stored {len(rows)} rows")
+            return len(rows)
+        except CACHE_ERRORS as e:
+            logging.warning(f"Cache batch storage failed, {len(rows)} rows not stored: {e}")
+            return 0
+
+
+# ==================== EPHEMERIS ====================
+
+# Rotation from ICRS to galactic axes, as used by astropy; its last row is the galactic
+# north pole in ICRS.
+ICRS_TO_GALACTIC = np.array([
+    [-0.0548756577125916, -0.8734370519556159, -0.4838350736167155],
+    [0.4941094371927268, -0.4448297212232952, 0.7469821839866676],
+    [-0.8676661375596576, -0.1980763372730006, 0.4559838136873016],
+])
+
+
+def compute_zenith_galactic_latitude(times, location):
+    """Signed galactic latitude b (deg) of the zenith for an astropy Time array"""
+    zenith = zenith_galactic_vectors(times, location)
+    return np.degrees(np.arcsin(np.clip(zenith[2], -1.0, 1.0)))
+
+
+def _exact_grid_vectors(unix_seconds, location):
+    """
+    Unit vectors of the sun and moon in AltAz and of the zenith in galactic coordinates
+    at grid times, stacked as a (9, n) array. Vector components are smooth in time,
+    unlike altitudes and |b| which have kinks at the zenith and the galactic poles.
+    """
+    times = Time(unix_seconds, format='unix', scale='utc')
+    altaz = AltAz(obstime=times, location=location)
+    sun = get_sun(times).transform_to(altaz).cartesian.xyz.value
+    moon = get_body("moon", times, location=location).transform_to(altaz).cartesian.xyz.value
+    zenith = zenith_galactic_vectors(times, location)
+    sun = sun / np.linalg.norm(sun, axis=0)
+    moon = moon / np.linalg.norm(moon, axis=0)
+    return np.vstack([sun, moon, zenith])
+
+
+def _grid_angles(vectors):
+    """Sun altitude, moon altitude and signed zenith b (deg) from stacked unit vectors, as a (3, n) array"""
+    v = vectors.reshape(3, 3, -1)
+    return np.degrees(np.arctan2(v[:, 2], np.hypot(v[:, 0], v[:, 1])))
+
+
+def interpolated_ephemeris(times, location, max_error_deg=EPHEMERIS_MAX_ERROR_DEG):
+    """
+    Sun altitude, moon altitude and zenith galactic latitude |b| (deg) for an astropy Time array,
+    evaluated with astropy on a coarse grid spanning the times and cubic-interpolated to each of them.
+
+    Direction unit vectors are interpolated (see _exact_grid_vectors) and converted to angles
+    afterwards. The grid step starts from the cubic spline error bound (5/384) h^4 max|f^(4)| for
+    a diurnal term of unit amplitude. Every interval midpoint is then compared with exact values
+    and the step is halved until all three angles are within max_error_deg.
+    """
+    x = np.atleast_1d(times.unix)
+    if len(x) == 0:
+        return np.empty(0), np.empty(0), np.empty(0)
+
+    omega = 2 * np.pi / SIDEREAL_DAY_S
+    step = (384.0 * np.radians(max_error_deg) / (5.0 * omega**4)) ** 0.25
+    x0 = x.min()
+    k = int(np.ceil((x.max() - x0) / step))
+    nodes = x0 + step * np.arange(-2, k + 3)   # two nodes of padding on both sides
+    node_values = _exact_grid_vectors(nodes, location)
+
+    while True:
+        spline = CubicSpline(nodes, node_values, axis=1)
+        mids = (nodes[:-1] + nodes[1:]) / 2
+        mid_values = _exact_grid_vectors(mids, location)
+        max_err = np.abs(_grid_angles(spline(mids)) - _grid_angles(mid_values)).max()
+        logging.debug(f"ephemeris grid: {len(nodes)} nodes, step {step:.0f}s, max error {max_err:.5f} deg")
+        if max_err <= max_error_deg:
+            break
+        step /= 2
+        if step < EPHEMERIS_MIN_GRID_STEP_S:
+            logging.warning(f"ephemeris grid did not reach {max_error_deg} deg, computing every timestamp exactly")
+            angles = _grid_angles(_exact_grid_vectors(x, location))
+            return angles[0], angles[1], np.abs(angles[2])
+        # halving the step: the midpoints just computed become nodes
+        order = np.argsort(np.concatenate([nodes, mids]), kind="stable")
+        nodes = np.concatenate([nodes, mids])[order]
+        node_values = np.concatenate([node_values, mid_values], axis=1)[:, order]
+
+    angles = _grid_angles(spline(x))
+    return angles[0], angles[1], np.abs(angles[2])
+
+
+def compute_sky_positions(unix_seconds):
+    """
+    Geocentric apparent (CIRS) RA, Dec (deg) and distance (km) of the sun and the moon.
+    These do not depend on the observer. Returns a (6, n) array in SKY_COLUMNS order.
+    """
+    times = Time(unix_seconds, format='unix', scale='utc')
+    cirs = CIRS(obstime=times)
+    sun = get_sun(times).transform_to(cirs)
+    moon = get_body("moon", times).transform_to(cirs)
+    return np.vstack([sun.ra.deg, sun.dec.deg, sun.distance.to(u.km).value,
+                      moon.ra.deg, moon.dec.deg, moon.distance.to(u.km).value])
+
+
+def cached_sky_positions(node_seconds, stats=None):
+    """
+    compute_sky_positions for grid times that are multiples of the cache step, served from
+    sky_cache where possible. Missing steps are computed in one batch and stored.
+    stats: optional dict, its "cache_hits" and "cache_misses" counters are increased.
+    """
     epoch = datetime(1970, 1, 1)
-    diff = (dt - epoch).total_seconds()
-    rounded_diff = (diff // bucket_seconds) * bucket_seconds
-    return epoch + __import__('datetime').timedelta(seconds=rounded_diff)
+    buckets = [epoch + timedelta(seconds=int(s)) for s in node_seconds]
+    cached = get_sky_cache(buckets)
 
+    values = np.full((6, len(buckets)), np.nan)
+    for k, time_bucket in enumerate(buckets):
+        row = cached.get(time_bucket)
+        if row is not None:
+            values[:, k] = [row[c] for c in SKY_COLUMNS[1:]]
+    missing = np.flatnonzero(np.isnan(values).any(axis=0))
+    if stats is not None:
+        stats["cache_hits"] = stats.get("cache_hits", 0) + len(buckets) - len(missing)
+        stats["cache_misses"] = stats.get("cache_misses", 0) + len(missing)
+    logging.debug(f"sky positions: {len(buckets)} steps, {len(missing)} to compute")
 
-def get_cache(lat, lon, t_astropy):
-    """Retrieve cached celestial values for location and time"""
-    if not CACHE_ENABLED:
-        return None
-    
-    try:
-        # Round location for cache lookup
-        lat_rounded, lon_rounded = round_location(lat, lon)
-        if lat_rounded is None or lon_rounded is None:
-            return None
-        
-        ## fixed lat lon for testing
-        lat_rounded = 55
+    if len(missing) > 0:
+        values[:, missing] = compute_sky_positions(np.asarray(node_seconds, dtype=float)[missing])
+        cache_writer = CacheWriteBuffer()
+        for k in missing:
+            cache_writer.add(buckets[k], *(float(v) for v in values[:, k]))
+        cache_writer.flush()
+    return values
 
-        # cover Møn longitude range
-        if (lon_rounded > 11.6 and lon_rounded < 13.0):
-            lon_rounded = 12.5
 
-        
-        time_bucket = get_time_bucket(t_astropy)
-        # conn = mysql.connector.connect(**DB_CONFIG)
-        cursor = conn.cursor(dictionary=True)
-        
-        query = """
-        SELECT sun_alt, moon_alt, mw_brightness, milky_way_visible 
-        FROM celestial_cache 
-        WHERE lat = %s AND lon = %s AND time_bucket = %s
-        """
-        cursor.execute(query, (lat_rounded, lon_rounded, time_bucket))
-        result = cursor.fetchone()
-        cursor.close()
-        # conn.close()
-        
-        if result:
-            # logging.debug(f"Cache HIT: {lat_rounded}, {lon_rounded}, {time_bucket}")
-            return result
+def _cartesian(ra_deg, dec_deg, dist=1.0):
+    ra = np.radians(ra_deg)
+    dec = np.radians(dec_deg)
+    return dist * np.array([np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra), np.sin(dec)])
+
+
+def earth_rotation_angle(times):
+    """Earth rotation angle (rad) for an astropy Time array"""
+    ut1 = times.ut1
+    return erfa.era00(ut1.jd1, ut1.jd2)
+
+
+def _geodetic_up(location):
+    lat = location.lat.rad
+    lon = location.lon.rad
+    return np.array([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+
+
+def site_altitudes(vectors, times, location, era=None):
+    """
+    Topocentric altitude (deg, no refraction) for geocentric CIRS position vectors (3, n)
+    in km at astropy times. The vectors are rotated by the Earth rotation angle into the
+    terrestrial frame (polar motion ignored), the observer's geocentric position is
+    subtracted for parallax and the altitude is taken against the geodetic vertical.
+    era: earth_rotation_angle(times), when the caller already has it.
+    """
+    if era is None:
+        era = earth_rotation_angle(times)
+    c, s = np.cos(era), np.sin(era)
+    v = np.array([c * vectors[0] + s * vectors[1], -s * vectors[0] + c * vectors[1], vectors[2]])
+    v = v - np.array([location.x.to(u.km).value, location.y.to(u.km).value,
+                      location.z.to(u.km).value])[:, None]
+    up = _geodetic_up(location)
+    sin_alt = (up[:, None] * v).sum(axis=0) / np.linalg.norm(v, axis=0)
+    return np.degrees(np.arcsin(np.clip(sin_alt, -1.0, 1.0)))
+
+
+def zenith_cirs(location, era):
+    """CIRS unit vectors (3, n) of the zenith (geodetic vertical) at Earth rotation angles era"""
+    up = _geodetic_up(location)
+    c, s = np.cos(era), np.sin(era)
+    return np.array([c * up[0] - s * up[1], s * up[0] + c * up[1], np.full(np.shape(era), up[2])])
+
+
+def _daily_precession_nutation(times):
+    """
+    GCRS -> CIRS matrices (3, 3, n) and the Earth's barycentric velocity in units of c
+    (3, n) for an astropy Time array, evaluated once per day and linearly interpolated.
+    """
+    tt = times.tt
+    days = np.atleast_1d((tt.jd1 - 2451545.0) + tt.jd2)
+    nodes = np.arange(np.floor(days.min()), np.floor(days.max()) + 2)
+    node_matrices = erfa.c2i06a(2451545.0, nodes).reshape(len(nodes), 9)
+    node_beta = erfa.epv00(2451545.0, nodes)[1]["v"] / erfa.DC
+    gcrs_to_cirs = np.array([np.interp(days, nodes, node_matrices[:, k]) for k in range(9)]).reshape(3, 3, -1)
+    beta = np.array([np.interp(days, nodes, node_beta[:, k]) for k in range(3)])
+    return gcrs_to_cirs, beta
+
+
+def zenith_galactic_vectors(times, location, era=None):
+    """
+    Galactic unit vectors (3, n) of the zenith for an astropy Time array, in closed form.
+    The zenith is (Earth rotation angle + longitude, latitude) in CIRS; the transposed
+    c2i06a matrix takes it to GCRS, the annual aberration is removed (first order in v/c)
+    and ICRS_TO_GALACTIC rotates it to galactic axes. Agrees with astropy's AltAz ->
+    galactic transform to about 0.0002 deg (polar motion and diurnal aberration ignored).
+
+    Precession-nutation and the Earth's velocity change by well under an arcsecond a day,
+    so they are evaluated once per day and linearly interpolated.
+    """
+    if era is None:
+        era = earth_rotation_angle(times)
+    gcrs_to_cirs, beta = _daily_precession_nutation(times)
+    zenith = np.einsum("jin,jn->in", gcrs_to_cirs, zenith_cirs(location, era))
+    zenith = zenith - beta + (beta * zenith).sum(axis=0) * zenith
+    return ICRS_TO_GALACTIC @ (zenith / np.linalg.norm(zenith, axis=0))
+
+
+def sky_cache_ephemeris(times, location, stats=None):
+    """
+    Sun altitude, moon altitude and zenith galactic latitude |b| (deg) for an astropy Time
+    array, from location independent sun and moon positions on the cache grid.
+    The positions (as cartesian km vectors) and the site's zenith galactic unit vector are
+    cubic-interpolated from the CACHE_TIME_BUCKET_MIN grid to each time, then site_altitudes
+    converts to altitudes. Within 0.001 deg of a full AltAz transform.
+    """
+    x = np.atleast_1d(times.unix)
+    if len(x) == 0:
+        return np.empty(0), np.empty(0), np.empty(0)
+    step = CACHE_TIME_BUCKET_MIN * 60
+    # two grid steps of padding on both sides for the spline
+    nodes = step * np.arange(np.floor(x.min() / step) - 2, np.floor(x.max() / step) + 4)
+
+    sky = cached_sky_positions(nodes, stats)
+    sun = CubicSpline(nodes, _cartesian(sky[0], sky[1], sky[2]), axis=1)(x)
+    moon = CubicSpline(nodes, _cartesian(sky[3], sky[4], sky[5]), axis=1)(x)
+
+    node_times = Time(nodes, format='unix', scale='utc')
+    zenith = CubicSpline(nodes, zenith_galactic_vectors(node_times, location), axis=1)(x)
+    b_deg = np.degrees(np.arctan2(zenith[2], np.hypot(zenith[0], zenith[1])))
+
+    return site_altitudes(sun, times, location), site_altitudes(moon, times, location), np.abs(b_deg)
+
+
+# ---- precomputed ephemeris table ----
+# build_ephemeris_table.py writes, every EPHEMERIS_TABLE_STEP_S for a range of years, the
+# geocentric CIRS positions (km) of the sun and the moon, the galactic north pole rotated
+# into CIRS axes and the Earth's barycentric velocity in units of c (for the aberration of
+# the zenith direction). Nothing in it depends on the observer: altitudes follow from
+# site_altitudes and the zenith galactic latitude from the angle between the zenith and the pole.
+# File layout: a 64 byte header (magic, start and step in unix seconds, rows, columns, little
+# endian int64) followed by the rows as little endian float32.
+
+EPHEMERIS_TABLE_MAGIC = b"SQMEPH01"
+EPHEMERIS_TABLE_COLUMNS = ("sun_x", "sun_y", "sun_z", "moon_x", "moon_y", "moon_z", "pole_x", "pole_y", "pole_z",
+                           "beta_x", "beta_y", "beta_z")
+EPHEMERIS_TABLE_HEADER = struct.Struct("<8sqqqq")
+EPHEMERIS_TABLE_OFFSET = 64
+
+
+def compute_ephemeris_table_rows(unix_seconds):
+    """Ephemeris table rows for unix times, as a float64 (n, 12) array in EPHEMERIS_TABLE_COLUMNS order"""
+    sky = compute_sky_positions(unix_seconds)
+    tt = Time(unix_seconds, format='unix', scale='utc').tt
+    gcrs_to_cirs = erfa.c2i06a(tt.jd1, tt.jd2)
+    pole = gcrs_to_cirs @ ICRS_TO_GALACTIC[2]
+    beta = np.einsum("nij,nj->ni", gcrs_to_cirs, erfa.epv00(tt.jd1, tt.jd2)[1]["v"] / erfa.DC)
+    return np.hstack([_cartesian(sky[0], sky[1], sky[2]).T, _cartesian(sky[3], sky[4], sky[5]).T, pole, beta])
+
+
+def write_ephemeris_table(path, start_s, step_s, rows):
+    """Write table rows (n, 12) starting at unix time start_s, replacing path atomically"""
+    header = EPHEMERIS_TABLE_HEADER.pack(EPHEMERIS_TABLE_MAGIC, int(start_s), int(step_s),
+                                         len(rows), len(EPHEMERIS_TABLE_COLUMNS))
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(header.ljust(EPHEMERIS_TABLE_OFFSET, b"\0"))
+        f.write(np.ascontiguousarray(rows, dtype="<f4").tobytes())
+    os.replace(tmp_path, path)
+
+
+class EphemerisTable:
+    """A memory-mapped ephemeris table file; only the pages covering a file's times are read"""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            magic, start_s, step_s, n_rows, n_columns = EPHEMERIS_TABLE_HEADER.unpack(
+                f.read(EPHEMERIS_TABLE_HEADER.size))
+        if magic != EPHEMERIS_TABLE_MAGIC or n_columns != len(EPHEMERIS_TABLE_COLUMNS):
+            raise ValueError(f"{path} is not an ephemeris table")
+        self.path = path
+        self.start_s = start_s
+        self.step_s = step_s
+        self.rows = np.memmap(path, dtype="<f4", mode="r", offset=EPHEMERIS_TABLE_OFFSET,
+                              shape=(n_rows, n_columns))
+
+    @property
+    def end_s(self):
+        return self.start_s + self.step_s * (len(self.rows) - 1)
+
+    def _span(self, x):
+        # two rows of padding on both sides for the spline
+        first = int(np.floor((x.min() - self.start_s) / self.step_s)) - 2
+        last = int(np.floor((x.max() - self.start_s) / self.step_s)) + 4
+        return first, last
+
+    def covers(self, x):
+        first, last = self._span(x)
+        return first >= 0 and last <= len(self.rows)
+
+    def interpolate(self, x):
+        """Table columns cubic-interpolated to unix times x, as a (12, n) array"""
+        first, last = self._span(x)
+        nodes = self.start_s + self.step_s * np.arange(first, last, dtype=float)
+        return CubicSpline(nodes, np.asarray(self.rows[first:last], dtype=float), axis=0)(x).T
+
+
+_ephemeris_table = None
+_ephemeris_table_failed = False
+
+
+def get_ephemeris_table():
+    """The EPHEMERIS_TABLE_PATH table, mapped on first use. None when it can't be read."""
+    global _ephemeris_table, _ephemeris_table_failed
+    if _ephemeris_table is None and not _ephemeris_table_failed:
+        try:
+            _ephemeris_table = EphemerisTable(EPHEMERIS_TABLE_PATH)
+            epoch = datetime(1970, 1, 1)
+            logging.info(f"Ephemeris table {EPHEMERIS_TABLE_PATH}: {len(_ephemeris_table.rows)} rows, "
+                         f"{epoch + timedelta(seconds=_ephemeris_table.start_s)} - "
+                         f"{epoch + timedelta(seconds=_ephemeris_table.end_s)}")
+        except (OSError, ValueError) as e:
+            _ephemeris_table_failed = True
+            logging.warning(f"Ephemeris table not available: {e}")
+    return _ephemeris_table
+
+
+def table_ephemeris(times, location, table):
+    """
+    Sun altitude, moon altitude and zenith galactic latitude |b| (deg) for an astropy Time
+    array from an EphemerisTable that covers the times.
+    """
+    x = np.atleast_1d(times.unix)
+    if len(x) == 0:
+        return np.empty(0), np.empty(0), np.empty(0)
+    values = table.interpolate(x)
+    era = earth_rotation_angle(times)
+    sun_alt = site_altitudes(values[0:3], times, location, era)
+    moon_alt = site_altitudes(values[3:6], times, location, era)
+    # the zenith is an apparent direction, remove the annual aberration before comparing it
+    # with the pole (first order in v/c, good to a few milliarcseconds)
+    zenith = zenith_cirs(location, era)
+    beta = values[9:12]
+    zenith = zenith - beta + (beta * zenith).sum(axis=0) * zenith
+    sin_b = (zenith * values[6:9]).sum(axis=0) / (np.linalg.norm(zenith, axis=0) * np.linalg.norm(values[6:9], axis=0))
+    return sun_alt, moon_alt, np.abs(np.degrees(np.arcsin(np.clip(sin_b, -1.0, 1.0))))
+
+
+def mw_zenith_brightness(b_deg):
+    """
+    Milky Way surface brightness (mag/arcsec^2) at zenith from galactic latitude.
+    Simple linear fade: at plane b=0 -> BASE_MW_SB_AT_PLANE,
+    at poles b=90 -> BASE_MW_SB_AT_PLANE + PLANE_TO_POLE_FADE
+    """
+    mw_sb_plane = BASE_MW_SB_AT_PLANE + (PLANE_TO_POLE_FADE * (np.asarray(b_deg) / 90.0))
+    airmass = 1.0  # zenith
+    return mw_sb_plane + EXTINCTION_COEFF * (airmass - 1.0)
+
+
+def beam_grid(fwhm_deg=MW_BEAM_FWHM_DEG, rings=MW_BEAM_RINGS, azimuths=MW_BEAM_AZIMUTHS):
+    """
+    Directions around the zenith for averaging over a Gaussian beam of fwhm_deg, out to
+    3 sigma (at most 85 deg). Returns local east/north/up unit vectors (3, m), their zenith
+    angles (deg) and weights (beam response times solid angle, summing to 1).
+    """
+    sigma = fwhm_deg / (2 * np.sqrt(2 * np.log(2)))
+    edges = np.linspace(0.0, min(3 * sigma, 85.0), rings + 1)
+    z = np.repeat((edges[:-1] + edges[1:]) / 2, azimuths)
+    az = np.tile((np.arange(azimuths) + 0.5) * 2 * np.pi / azimuths, rings)
+    zr = np.radians(z)
+    directions = np.array([np.sin(zr) * np.sin(az), np.sin(zr) * np.cos(az), np.cos(zr)])
+    weights = np.exp(-0.5 * (z / sigma) ** 2) * np.sin(zr)
+    return directions, z, weights / weights.sum()
+
+
+def mw_beam_brightness(times, location, fwhm_deg=MW_BEAM_FWHM_DEG, step_s=MW_BEAM_STEP_S):
+    """
+    Milky Way surface brightness (mag/arcsec^2) seen through the SQM beam, for an astropy
+    Time array. For every direction of beam_grid the galactic latitude comes from the same
+    closed-form rotation as zenith_galactic_vectors, the plane-to-pole model of
+    mw_zenith_brightness gives its brightness and estimate_mw_surface_brightness adds the
+    Kasten airmass extinction. The beam-weighted mean flux is converted back to magnitudes.
+    Evaluated as (timestamps x directions) arrays, MW_BEAM_CHUNK timestamps at a time.
+    With step_s the model is evaluated only at the multiples of step_s around the times and
+    linearly interpolated.
+    """
+    if step_s:
+        x = np.atleast_1d(times.unix)
+        k = np.floor(x / step_s)
+        nodes = np.unique(np.concatenate([k, k + 1])) * step_s
+        node_sb = mw_beam_brightness(Time(nodes, format='unix', scale='utc'), location, fwhm_deg, step_s=0)
+        return np.interp(x, nodes, node_sb)
+
+    directions, z_deg, weights = beam_grid(fwhm_deg)
+    airmass = airmass_kasten(z_deg)
+    era = earth_rotation_angle(times)
+    gcrs_to_cirs, beta = _daily_precession_nutation(times)
+
+    # galactic pole and Earth velocity in the local east/north/up frame of every timestamp
+    lat = location.lat.rad
+    lon = location.lon.rad
+    enu = np.array([[-np.sin(lon), np.cos(lon), 0.0],
+                    [-np.sin(lat) * np.cos(lon), -np.sin(lat) * np.sin(lon), np.cos(lat)],
+                    _geodetic_up(location)])
+    c, s = np.cos(era), np.sin(era)
+
+    def to_local(v_gcrs):
+        v = np.einsum("ijn,jn->in", gcrs_to_cirs, v_gcrs)
+        return enu @ np.array([c * v[0] + s * v[1], -s * v[0] + c * v[1], v[2]])
+
+    pole = to_local(np.repeat(ICRS_TO_GALACTIC[2][:, None], len(era), axis=1))
+    beta = to_local(beta)
+
+    mw_sb = np.empty(len(era))
+    for start in range(0, len(era), MW_BEAM_CHUNK):
+        part = slice(start, start + MW_BEAM_CHUNK)
+        pole_dot = pole[:, part].T @ directions
+        beta_dot = beta[:, part].T @ directions
+        # directions are apparent, remove the annual aberration (first order in v/c)
+        sin_b = pole_dot - (pole[:, part] * beta[:, part]).sum(axis=0)[:, None] + beta_dot * pole_dot
+        b_deg = np.degrees(np.arcsin(np.clip(sin_b, -1.0, 1.0)))
+        sb = estimate_mw_surface_brightness(airmass, base_sb=mw_zenith_brightness(np.abs(b_deg)),
+                                            extinction_coeff=EXTINCTION_COEFF)
+        mw_sb[part] = -2.5 * np.log10((10 ** (-0.4 * sb)) @ weights)
+    return mw_sb
+
+
+def compute_file_ephemeris(times, location, stats=None):
+    """
+    Batch ephemeris stage for process_stream.
+    times: astropy Time array with every timestamp that reaches the ephemeris step.
+    Returns (sun_alt, moon_alt, mw_sb) arrays. moon_alt and mw_sb are NaN where the sun
+    is above the horizon, since those lines never need them.
+
+    EPHEMERIS_MODE "interpolated" uses interpolated_ephemeris and does not touch the cache.
+    "sky_cache" uses sky_cache_ephemeris: sun and moon positions come from the location
+    independent sky cache (in-memory LRU, then one range query, missing steps computed and
+    stored in one batched write) and are converted to altitudes for this site.
+    "table" looks everything up in the precomputed ephemeris table; files outside the table
+    (or without a table) fall back to "interpolated".
+    mw_sb follows MW_MODEL: the zenith model, or mw_beam_brightness over the SQM beam.
+    stats: optional dict, its "cache_hits" and "cache_misses" step counters are increased.
+    """
+    table = get_ephemeris_table() if EPHEMERIS_MODE == "table" else None
+    if table is not None and len(times) > 0 and not table.covers(np.atleast_1d(times.unix)):
+        logging.warning(f"Ephemeris table does not cover {times.min().iso} - {times.max().iso}, interpolating")
+        table = None
+    if table is not None:
+        sun_alt, moon_alt, b_deg = table_ephemeris(times, location, table)
+    elif EPHEMERIS_MODE in ("interpolated", "table"):
+        sun_alt, moon_alt, b_deg = interpolated_ephemeris(times, location)
+    else:
+        sun_alt, moon_alt, b_deg = sky_cache_ephemeris(times, location, stats)
+        logging.debug(f"Sky cache LRU: {sky_lru.stats()}")
+    if MW_MODEL == "beam":
+        mw_sb = np.full(len(sun_alt), np.nan)
+        night = np.flatnonzero(sun_alt < 0)
+        if len(night) > 0:
+            mw_sb[night] = mw_beam_brightness(times[night], location)
+    else:
+        mw_sb = mw_zenith_brightness(b_deg)
+    day = sun_alt >= 0
+    moon_alt[day] = np.nan
+    mw_sb[day] = np.nan
+    return sun_alt, moon_alt, mw_sb
+
+
+# ==================== ROLLING STATISTICS ====================
+
+class RollingStats:
+    """
+    Mean and standard deviation of the values inside a sliding time window.
+
+    push() appends on the right and evict() drops old values from the left, both O(1)
+    amortized, with running sums instead of rescanning the window. MPSAS readings have
+    two decimals, so while every value in the window is a multiple of 1/scale the sums
+    are kept as exact integers and the variance is exact. Otherwise float sums relative
+    to a reference value are used; they are reset whenever the window runs empty so
+    rounding cannot accumulate.
+
+    Timestamps are plain float seconds. While the window holds out-of-order timestamps
+    (clock jumps in the logger), evict() filters the whole window instead, so the result
+    is the same as keeping every value newer than the cutoff.
+    """
+
+    def __init__(self, scale=100):
+        self.scale = scale
+        self.window = deque()   # (seconds, value)
+        self.ordered = True
+        self.exact = True
+        self.isum = 0
+        self.isumsq = 0
+        self.ref = 0.0
+        self.sum = 0.0
+        self.sumsq = 0.0
+
+    def __len__(self):
+        return len(self.window)
+
+    def push(self, t_seconds, value):
+        if not self.window:
+            self.ref = value
+            self.sum = 0.0
+            self.sumsq = 0.0
+            self.exact = True
+            self.isum = 0
+            self.isumsq = 0
+        elif t_seconds < self.window[-1][0]:
+            self.ordered = False
+        d = value - self.ref
+        self.window.append((t_seconds, value))
+        self.sum += d
+        self.sumsq += d * d
+        if self.exact:
+            c = round(value * self.scale)
+            if abs(value * self.scale - c) > 1e-6:
+                self.exact = False
+            else:
+                self.isum += c
+                self.isumsq += c * c
+
+    def evict(self, cutoff_seconds):
+        """Drop values with timestamp <= cutoff_seconds"""
+        if not self.ordered:
+            self._filter(cutoff_seconds)
+            return
+        while self.window and self.window[0][0] <= cutoff_seconds:
+            _, value = self.window.popleft()
+            d = value - self.ref
+            self.sum -= d
+            self.sumsq -= d * d
+            if self.exact:
+                c = round(value * self.scale)
+                self.isum -= c
+                self.isumsq -= c * c
+
+    def _filter(self, cutoff_seconds):
+        kept = [(tt, v) for tt, v in self.window if tt > cutoff_seconds]
+        self.window = deque()
+        self.ordered = True
+        for tt, v in kept:
+            self.push(tt, v)
+
+    def mean(self):
+        n = len(self.window)
+        return self.ref + self.sum / n if n else np.nan
+
+    def std(self):
+        """Population standard deviation (ddof=0), same as np.std"""
+        n = len(self.window)
+        if n == 0:
+            return np.nan
+        if self.exact:
+            num = n * self.isumsq - self.isum * self.isum
+            return math.sqrt(num) / n / self.scale if num > 0 else 0.0
+        var = (self.sumsq - self.sum * self.sum / n) / n
+        return math.sqrt(var) if var > 0 else 0.0
+
+
+def rolling_std(seconds, values, window_s, scale=100):
+    """
+    Vectorized counterpart of RollingStats: for every line the population stdev of the
+    values pushed so far with timestamp > seconds[i] - window_s[i] (NaN below 2 values).
+    seconds must be non-decreasing. Uses the same exact integer arithmetic as RollingStats
+    when all values are multiples of 1/scale, so both give identical results.
+    """
+    n = len(values)
+    if n == 0:
+        return np.empty(0)
+    # first index inside each window; evicted values never come back
+    start = np.maximum.accumulate(np.searchsorted(seconds, seconds - window_s, side='right'))
+    end = np.arange(1, n + 1)
+    count = end - start
+
+    scaled = np.round(values * scale)
+    exact = np.all(np.abs(values * scale - scaled) <= 1e-6) and \
+        float(count.max()) ** 2 * float((scaled ** 2).max()) < 2.0 ** 62
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if exact:
+            c = scaled.astype(np.int64)
+            s1 = np.concatenate([[0], np.cumsum(c)])
+            s2 = np.concatenate([[0], np.cumsum(c * c)])
+            total = s1[end] - s1[start]
+            num = count * (s2[end] - s2[start]) - total * total
+            std = np.sqrt(np.maximum(num, 0).astype(float)) / count / scale
         else:
-            logging.debug(f"Cache MISS: {lat_rounded}, {lon_rounded}, {time_bucket}")
-            return None
-    except Error as e:
-        logging.warning(f"Cache retrieval failed: {e}")
-        return None
+            d = values - values[0]
+            s1 = np.concatenate([[0.0], np.cumsum(d)])
+            s2 = np.concatenate([[0.0], np.cumsum(d * d)])
+            total = s1[end] - s1[start]
+            var = ((s2[end] - s2[start]) - total * total / count) / count
+            std = np.sqrt(np.maximum(var, 0.0))
+    std[count < 2] = np.nan
+    return std
+
+
+# ==================== FILTER ENGINES ====================
+# Both engines take the kept lines of a file (time, MPSAS, ephemeris) and make the
+# accept/reject decisions of process_stream. "loop" is the line-by-line reference,
+# "vectorized" does the same with boolean masks. They return the same dict:
+# accepted line indices with their moon_alt, mw_sb and roll_stdev, the index of the
+# line where the line limit stopped processing (or None) and the counters.
+
+def filter_rows_loop(seconds, mpsas_values, sun_alts, moon_alts, mw_sbs, roll_window_s,
+                     sun_max_alt, moon_max_alt, stdev_threshold, mw_sb_threshold, line_limit):
+    """Reference filter engine, one line at a time"""
+    rolling = RollingStats()  # MPSAS inside the rolling window
+    accepted = []
+    accepted_moon = []
+    accepted_mw = []
+    accepted_stdev = []
+    stop = None
+    milky_way_visible_count = 0
+    cloudy_count = 0
+    sun_moon_lines_rejected = 0
+    total_mpsas = 0
+    used_lines = 0
+    max_mpsas = 0
+    total_mw_sb = 0
+    count_mw_sb = 0
+
+    moon_alt = None
+    mw_sb = None
+    milky_way_visible = False
+    for i in range(len(seconds)):
+        mpsas = mpsas_values[i]
+
+        # append to rolling window, drop values older than the window
+        rolling.push(seconds[i], mpsas)
+        rolling.evict(seconds[i] - roll_window_s[i])
+
+        sun_alt = sun_alts[i]
+        # moon and Milky Way values are only computed when sun is below horizon (sun_alt < 0),
+        # daytime lines keep the previous night values
+        if sun_alt < 0:
+            moon_alt = moon_alts[i]
+            mw_sb = mw_sbs[i]
+
+            milky_way_visible = (mw_sb < mw_sb_threshold)
+            if milky_way_visible:
+                milky_way_visible_count +=1
+            
+            total_mw_sb += mw_sb
+            count_mw_sb += 1
 
+            if (debug > 0):
+                logging.debug(f"moon_alt: {moon_alt}")
+                logging.debug(f"sun_alt: {sun_alt}")
+
+        # only calculate roll_stdev if both sun/moon are below limits
+        if moon_alt is not None and sun_alt < sun_max_alt and moon_alt < moon_max_alt:
+            roll_stdev = rolling.std() if len(rolling) >= 2 else np.nan
+            if not np.isnan(roll_stdev) and roll_stdev < stdev_threshold:
+                if (not milky_way_visible):
+                    accepted.append(i)
+                    accepted_moon.append(moon_alt)
+                    accepted_mw.append(mw_sb)
+                    accepted_stdev.append(roll_stdev)
+                    total_mpsas = total_mpsas + mpsas
+                    used_lines = used_lines + 1
+                    
+                    # keep maximum mpsas in file
+                    if mpsas > max_mpsas:
+                        max_mpsas = mpsas
+                else:
+                    logging.debug(f"Rejected: milky_way_visible {milky_way_visible} mw_sb: {mw_sb:.2f} < {mw_sb_threshold}, mpsas {mpsas}")
+            else:
+                cloudy_count += 1
+        else:
+            # sun_alt >= sun_max_alt or moon_alt >= moon_max_alt - conditions not met
+            sun_moon_lines_rejected += 1
 
-def set_cache(lat, lon, t_astropy, sun_alt, moon_alt, mw_brightness, milky_way_visible):
-    """Store calculated celestial values in cache"""
-    if not CACHE_ENABLED:
-        return False
-    
-    try:
-        # Round location for cache storage
-        lat_rounded, lon_rounded = round_location(lat, lon)
-        if lat_rounded is None or lon_rounded is None:
-            return False
-        
-        time_bucket = get_time_bucket(t_astropy)
-        # conn = mysql.connector.connect(**DB_CONFIG)
-        cursor = conn.cursor()
-        
-        query = """
-        INSERT INTO celestial_cache (lat, lon, time_bucket, sun_alt, moon_alt, mw_brightness, milky_way_visible)
-        VALUES (%s, %s, %s, %s, %s, %s, %s)
-        ON DUPLICATE KEY UPDATE 
-            sun_alt = VALUES(sun_alt), 
-            moon_alt = VALUES(moon_alt),
-            mw_brightness = VALUES(mw_brightness),
-            milky_way_visible = VALUES(milky_way_visible)
-        """
-        cursor.execute(query, (lat_rounded, lon_rounded, time_bucket, sun_alt, moon_alt, mw_brightness, milky_way_visible))
-        conn.commit()
-        cursor.close()
-        # conn.close()
-        logging.debug(f"Cache stored: {lat_rounded}, {lon_rounded}, {time_bucket}")
-        return True
-    except Error as e:
-        logging.warning(f"Cache storage failed: {e}")
-        return False
+        if (used_lines > line_limit):
+            stop = i
+            break
 
-    
+    return {
+        "accepted": np.array(accepted, dtype=int),
+        "moon_alt": np.array(accepted_moon, dtype=float),
+        "mw_sb": np.array(accepted_mw, dtype=float),
+        "roll_stdev": np.array(accepted_stdev, dtype=float),
+        "stop": stop,
+        "milky_way_visible_count": milky_way_visible_count,
+        "cloudy_count": cloudy_count,
+        "sun_moon_lines_rejected": sun_moon_lines_rejected,
+        "used_lines": used_lines,
+        "total_mpsas": total_mpsas,
+        "max_mpsas": max_mpsas,
+        "total_mw_sb": total_mw_sb,
+        "count_mw_sb": count_mw_sb,
+    }
+
+
+def filter_rows_vectorized(seconds, mpsas_values, sun_alts, moon_alts, mw_sbs, roll_window_s,
+                           sun_max_alt, moon_max_alt, stdev_threshold, mw_sb_threshold, line_limit):
+    """Filter engine working on whole columns with boolean masks"""
+    n = len(seconds)
+    if n > 1 and np.any(np.diff(seconds) < 0):
+        logging.debug("timestamps out of order, using the loop filter engine")
+        return filter_rows_loop(seconds, mpsas_values, sun_alts, moon_alts, mw_sbs, roll_window_s,
+                                sun_max_alt, moon_max_alt, stdev_threshold, mw_sb_threshold, line_limit)
+
+    roll_stdev = rolling_std(seconds, mpsas_values, roll_window_s)
+
+    # daytime lines keep the moon and Milky Way values of the previous night line
+    night = sun_alts < 0
+    last_night = np.maximum.accumulate(np.where(night, np.arange(n), -1))
+    seen_night = last_night >= 0
+    moon_alt = np.where(seen_night, moon_alts[last_night], np.nan)
+    mw_sb = np.where(seen_night, mw_sbs[last_night], np.nan)
+    night_mw_visible = night & (mw_sbs < mw_sb_threshold)
+    milky_way_visible = seen_night & night_mw_visible[last_night]
+
+    sun_moon_ok = seen_night & (sun_alts < sun_max_alt) & (moon_alt < moon_max_alt)
+    clear = roll_stdev < stdev_threshold   # NaN compares False
+    accepted = sun_moon_ok & clear & ~milky_way_visible
+
+    # the line limit stops processing right after the line that exceeds it
+    stop = None
+    end = n
+    accepted_idx = np.flatnonzero(accepted)
+    if len(accepted_idx) > line_limit:
+        stop = int(accepted_idx[line_limit])
+        end = stop + 1
+        accepted_idx = accepted_idx[:line_limit + 1]
+
+    # cumsum adds left to right like the loop, so the totals are bit-identical
+    accepted_mpsas = mpsas_values[accepted_idx]
+    night_mw = mw_sbs[:end][night[:end]]
+    return {
+        "accepted": accepted_idx,
+        "moon_alt": moon_alt[accepted_idx],
+        "mw_sb": mw_sb[accepted_idx],
+        "roll_stdev": roll_stdev[accepted_idx],
+        "stop": stop,
+        "milky_way_visible_count": int(night_mw_visible[:end].sum()),
+        "cloudy_count": int((sun_moon_ok & ~clear)[:end].sum()),
+        "sun_moon_lines_rejected": int((~sun_moon_ok)[:end].sum()),
+        "used_lines": len(accepted_idx),
+        "total_mpsas": np.cumsum(accepted_mpsas)[-1] if len(accepted_mpsas) else 0,
+        "max_mpsas": max(0, accepted_mpsas.max()) if len(accepted_mpsas) else 0,
+        "total_mw_sb": np.cumsum(night_mw)[-1] if len(night_mw) else 0,
+        "count_mw_sb": len(night_mw),
+    }
+
+
+FILTER_ENGINES = {
+    "loop": filter_rows_loop,
+    "vectorized": filter_rows_vectorized,
+}
 
 
 def parse_header(file, max_lines=50):
@@ -333,19 +1389,331 @@ def parse_header(file, max_lines=50):
 
     return lat, lon, location_name, serial_number, len(header_lines)
 
-def parse_time(tstr):
-    """Parse UTC timestamp from file"""
-    match = re.search(r'(\d+)-(\d+)-(\d+)T(\d+):(\d+):(\d+)', tstr)
-    if not match:
-        #return None
-        return Time(datetime(2025, 10, 15, 10, 20, 30), scale='utc')
-    y, m, d, H, M, S = map(int, match.groups())
-    return Time(datetime(y, m, d, H, M, S), scale='utc')
+def _utc_to_datetime64(tstr):
+    """Single timestamp string to datetime64[ms], NaT if it is malformed"""
+    try:
+        return np.datetime64(tstr.strip(), 'ms')
+    except ValueError:
+        return np.datetime64('NaT', 'ms')
+
+
+def parse_time_column(values):
+    """
+    Timestamp strings (2024-03-19T16:07:05.000) to datetime64[ms], NaT where malformed.
+    The whole column is converted by NumPy in one call; only a column containing malformed
+    entries is retried string by string. datetime64 input is only converted to ms.
+    """
+    values = np.asarray(values)
+    if values.dtype.kind == 'M':
+        return values.astype('datetime64[ms]')
+    strings = values.astype(str)
+    try:
+        return strings.astype('datetime64[ms]')
+    except ValueError:
+        return np.array([_utc_to_datetime64(x) for x in strings], dtype='datetime64[ms]')
+
+
+def read_sqm_chunks(f, chunk_rows=READ_CHUNK_ROWS):
+    """
+    Read the data body of an SQM .dat file as chunks of NumPy columns.
+    f must be positioned after the header, which is where parse_header leaves it.
+
+    Yields dicts with 'line' (line number after the header), 'utc', 'local', 'record_type'
+    (str), 'temperature', 'voltage', 'mpsas' (float, NaN if unreadable) and 'lines_read'
+    (lines in the chunk, blank and malformed ones included).
+    Blank lines are dropped; lines with fewer than 6 fields are logged and dropped.
+    """
+    try:
+        reader = pd.read_csv(f, sep=";", header=None, names=list(range(6)), usecols=range(6),
+                             dtype=str, na_filter=False, skip_blank_lines=False,
+                             quoting=csv.QUOTE_NONE, chunksize=chunk_rows)
+    except pd.errors.EmptyDataError:
+        return
+
+    first_line = 1
+    for df in reader:
+        n = len(df)
+        line = np.arange(first_line, first_line + n)
+        first_line += n
+
+        fields = [df[k].str.strip() for k in range(6)]
+        blank = np.logical_and.reduce([(col == "").to_numpy() for col in fields])
+        # a missing record type means the line had fewer than 6 fields
+        short = (fields[5] == "").to_numpy() & ~blank
+        for i in np.flatnonzero(short):
+            logging.warning(f"Skipping malformed line {line[i]}: {';'.join(df.iloc[i]).rstrip(';')}")
+
+        keep = ~(blank | short)
+        yield {
+            "line": line[keep],
+            "utc": fields[0].to_numpy(dtype=object)[keep],
+            "local": fields[1].to_numpy(dtype=object)[keep],
+            "temperature": pd.to_numeric(fields[2], errors="coerce").to_numpy(dtype=float)[keep],
+            "voltage": pd.to_numeric(fields[3], errors="coerce").to_numpy(dtype=float)[keep],
+            "mpsas": pd.to_numeric(fields[4], errors="coerce").to_numpy(dtype=float)[keep],
+            "record_type": fields[5].to_numpy(dtype=object)[keep],
+            "lines_read": n,
+        }
+
+
+# ==================== PROCESSED ROWS ====================
+
+PROCESSED_HEADER = "UTC_TIME;LOCAL_TIME;SUN_ALT;MOON_ALT;MPSAS;MW_BRIGHTNESS;MW_VISIBLE;ROLL_STDEV"
+
+
+def processed_rows(utc_time, local_time, sun_alt, moon_alt, mpsas, mw_sb, mw_visible, roll_stdev):
+    """
+    The accepted lines of a file as typed columns: 'utc_time' and 'local_time'
+    (datetime64[ms], NaT if unreadable), 'sun_alt', 'moon_alt', 'mpsas', 'mw_sb',
+    'roll_stdev' (float) and 'mw_visible' (bool). This is what the plot and the writers
+    take; times are given as datetime64 or as strings (see parse_time_column). Text is
+    only made when a CSV is written.
+    """
+    return {
+        "utc_time": parse_time_column(utc_time),
+        "local_time": parse_time_column(local_time),
+        "sun_alt": np.asarray(sun_alt, dtype=float),
+        "moon_alt": np.asarray(moon_alt, dtype=float),
+        "mpsas": np.asarray(mpsas, dtype=float),
+        "mw_sb": np.asarray(mw_sb, dtype=float),
+        "mw_visible": np.asarray(mw_visible, dtype=bool),
+        "roll_stdev": np.asarray(roll_stdev, dtype=float),
+    }
+
+
+def processed_csv_chunks(rows, chunk_rows=READ_CHUNK_ROWS):
+    """Processed rows as the ;-separated CSV text, header first, chunk_rows lines per piece"""
+    yield f"{PROCESSED_HEADER}\n"
+    for start in range(0, len(rows["mpsas"]), chunk_rows):
+        part = slice(start, start + chunk_rows)
+        utc = np.datetime_as_string(rows["utc_time"][part], unit='ms')
+        local = np.datetime_as_string(rows["local_time"][part], unit='ms')
+        yield "".join([
+            f"{utc_str};{local_str};{sun_alt:.3f};{moon_alt:.3f};{mpsas:.3f};{mw_sb:.2f};{visible};{roll_stdev:.4f}\n"
+            for utc_str, local_str, sun_alt, moon_alt, mpsas, mw_sb, visible, roll_stdev in zip(
+                utc.tolist(), local.tolist(), rows["sun_alt"][part].tolist(), rows["moon_alt"][part].tolist(),
+                rows["mpsas"][part].tolist(), rows["mw_sb"][part].tolist(), rows["mw_visible"][part].tolist(),
+                rows["roll_stdev"][part].tolist())])
+
+
+def night_averages(rows):
+    """
+    Accepted lines, average MPSAS and average Milky Way brightness per night. A night is
+    named after the local date it starts on (local time minus 12 hours).
+    """
+    valid = ~np.isnat(rows["local_time"])
+    nights = (rows["local_time"][valid] - np.timedelta64(12, 'h')).astype('datetime64[D]')
+    names, index, counts = np.unique(nights, return_inverse=True, return_counts=True)
+    mpsas = np.bincount(index, weights=rows["mpsas"][valid], minlength=len(names)) / np.maximum(counts, 1)
+    mw_sb = np.bincount(index, weights=rows["mw_sb"][valid], minlength=len(names)) / np.maximum(counts, 1)
+    return [{"night": str(name), "lines": int(count), "average_mpsas": round(float(m), 3),
+             "average_mw_brightness": round(float(w), 3)}
+            for name, count, m, w in zip(names, counts, mpsas, mw_sb)]
+
+
+def write_processed_csv(path, rows):
+    """Write processed rows as the ;-separated CSV, formatted and written a chunk at a time"""
+    with open(path, "w") as out:
+        out.writelines(processed_csv_chunks(rows))
+
+
+def write_processed_csv_gz(path, rows):
+    """Write processed rows as gzip compressed CSV"""
+    with gzip.open(path, "wt", compresslevel=OUTPUT_GZIP_LEVEL) as out:
+        out.writelines(processed_csv_chunks(rows))
+
+
+def write_processed_parquet(path, rows):
+    """
+    Write processed rows as Parquet with the CSV's column names. Times are timestamp[ms]
+    (UTC_TIME in UTC, LOCAL_TIME without zone), values are rounded as in the CSV.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    table = pa.table({
+        "UTC_TIME": pa.array(rows["utc_time"], type=pa.timestamp("ms", tz="UTC")),
+        "LOCAL_TIME": pa.array(rows["local_time"], type=pa.timestamp("ms")),
+        "SUN_ALT": np.round(rows["sun_alt"], 3),
+        "MOON_ALT": np.round(rows["moon_alt"], 3),
+        "MPSAS": np.round(rows["mpsas"], 3),
+        "MW_BRIGHTNESS": np.round(rows["mw_sb"], 2),
+        "MW_VISIBLE": rows["mw_visible"],
+        "ROLL_STDEV": np.round(rows["roll_stdev"], 4),
+    })
+    pq.write_table(table, path, compression="zstd")
+
+
+# output format -> (file name suffix, media type, writer, required module)
+OUTPUT_FORMATS = {
+    "csv": ("", "text/csv", write_processed_csv, None),
+    "csv.gz": (".gz", "application/gzip", write_processed_csv_gz, None),
+    "parquet": (".parquet", "application/vnd.apache.parquet", write_processed_parquet, "pyarrow"),
+}
+
+
+def output_format_error(output_format):
+    """Why output_format can't be used here, None if it can"""
+    if output_format not in OUTPUT_FORMATS:
+        return f"unknown output format {output_format!r}, use one of {', '.join(OUTPUT_FORMATS)}"
+    module = OUTPUT_FORMATS[output_format][3]
+    if module and importlib.util.find_spec(module) is None:
+        return f"output format {output_format!r} needs {module}, which is not installed"
+    return None
+
+
+def processed_file_name(filename, output_format):
+    """Download file name of a processed upload"""
+    return f"processed_{filename}{OUTPUT_FORMATS[output_format][0]}"
+
+
+def read_processed_csv(path):
+    """Processed rows from a processed file, CSV (plain or .gz) or Parquet"""
+    if str(path).endswith(".parquet"):
+        df = pd.read_parquet(path)
+        return processed_rows(df["UTC_TIME"].dt.tz_localize(None).to_numpy(), df["LOCAL_TIME"].to_numpy(),
+                              df["SUN_ALT"], df["MOON_ALT"], df["MPSAS"], df["MW_BRIGHTNESS"], df["MW_VISIBLE"],
+                              df["ROLL_STDEV"])
+    df = pd.read_csv(path, sep=";", dtype={"UTC_TIME": str, "LOCAL_TIME": str}, na_filter=False)
+    return processed_rows(df["UTC_TIME"], df["LOCAL_TIME"], df["SUN_ALT"], df["MOON_ALT"], df["MPSAS"],
+                          df["MW_BRIGHTNESS"], df["MW_VISIBLE"].astype(str) == "True", df["ROLL_STDEV"])
+
+
+# ==================== REPORT ====================
+
+class ProcessingReport:
+    """
+    What process_stream found: parameters, location, counters, averages, a histogram of
+    measurement intervals and a capped list of notable events. Filled while processing
+    and rendered once at the end, as text (to_text), an HTML fragment (to_html) or a
+    JSON-able dict (to_dict).
+    """
+
+    COUNTERS = ("lines_processed", "accepted_lines", "mw_rejected", "cloudy_rejected", "sun_moon_rejected",
+                "mpsas_low_rejected", "mpsas_high_rejected", "bad_time_rejected")
+
+    def __init__(self, params, max_events=REPORT_MAX_EVENTS):
+        self.params = dict(params)
+        self.lat = None
+        self.lon = None
+        self.location_name = None
+        self.header_lines = 0
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+        self.average_mpsas = 0.0
+        self.average_mw_sb = 0.0
+        self.intervals = {}          # measurement interval (s) -> count
+        self.nights = []             # night_averages of the accepted lines
+        self.stopped_early = False
+        self.max_events = max_events
+        self.events = []
+        self.events_dropped = 0
+
+    def event(self, message):
+        """Record a notable line; beyond max_events only the number is kept"""
+        if len(self.events) < self.max_events:
+            self.events.append(message)
+        else:
+            self.events_dropped += 1
+
+    def add_intervals(self, seconds):
+        """Count the intervals between consecutive timestamps (unix seconds, file order)"""
+        steps = np.diff(np.asarray(seconds, dtype=float))
+        values, counts = np.unique(np.round(steps[steps > 0]).astype(np.int64), return_counts=True)
+        for value, count in zip(values.tolist(), counts.tolist()):
+            self.intervals[value] = self.intervals.get(value, 0) + count
+
+    def common_intervals(self):
+        """(interval_s, count) of the REPORT_MAX_INTERVALS most common intervals and the count of all others"""
+        ranked = sorted(self.intervals.items(), key=lambda item: (-item[1], item[0]))
+        return ranked[:REPORT_MAX_INTERVALS], sum(count for _, count in ranked[REPORT_MAX_INTERVALS:])
+
+    def to_dict(self):
+        top, others = self.common_intervals()
+        return {
+            "params": self.params,
+            "location": {"lat": self.lat, "lon": self.lon, "name": self.location_name},
+            "header_lines": self.header_lines,
+            "counters": dict(self.counters),
+            "average_mpsas": float(self.average_mpsas),
+            "average_mw_brightness": float(self.average_mw_sb),
+            "intervals": [{"seconds": value, "count": count} for value, count in top],
+            "other_intervals": others,
+            "nights": list(self.nights),
+            "stopped_early": self.stopped_early,
+            "events": list(self.events),
+            "events_dropped": self.events_dropped,
+        }
+
+    def _lines(self):
+        """The report as (text, emphasized) lines"""
+        p = self.params
+        c = self.counters
+        lines = [("output:", False),
+                 ("Processing file with params: ", False),
+                 (f"mpsas_limit {p['mpsas_limit']} ", False),
+                 (f"sun_max_alt {p['sun_max_alt']} ", False),
+                 (f"moon_max_alt {p['moon_max_alt']} ", False),
+                 (f"roll_duration_min {p['roll_duration_min']} ", False),
+                 (f"stdev_threshold {p['stdev_threshold']}", False),
+                 (f"mpsas_high_limit {p['mpsas_high_limit']}", False),
+                 (f"Milky Way brightness threshold: {p['mw_sb_threshold']}", False)]
+        if self.lat is None or self.lon is None:
+            lines += [(f"Missing location, using default: {self.lat}:{self.lon}", True),
+                      ("Sunrise, Sunset, Moonrise and Moonset times will not be precise", True)]
+        else:
+            lines.append((f"Location: {self.lat}:{self.lon}", False))
+        lines += [(f"Location name: {self.location_name}", False),
+                  (f"Header lines: {self.header_lines}", False)]
+        if self.stopped_early:
+            lines.append((f"Ending after {c['accepted_lines']} good lines, because your device is not registered", False))
+        lines += [(f"Finished processing {c['lines_processed']} lines", False),
+                  (f"Accepted lines {c['accepted_lines']}", False),
+                  (f"Average MPSAS for {self.location_name}: {self.average_mpsas:.2f} ", False),
+                  (f"Milky way brightness lines rejected: {c['mw_rejected']},  light < {p['mw_sb_threshold']}", False),
+                  (f"Cloudy lines rejected (stdev > {p['stdev_threshold']}): {c['cloudy_rejected']} ", False),
+                  (f"Sun/Moon altitude lines rejected: {c['sun_moon_rejected']} ", False),
+                  (f"MPSAS high lines rejected: {c['mpsas_high_rejected']}, (MPSAS > {p['mpsas_high_limit']}) ", False)]
+        if c["bad_time_rejected"] > 0:
+            lines.append((f"Lines with unreadable timestamps rejected: {c['bad_time_rejected']} ", False))
+        lines += [(f"Average MPSAS for {self.location_name}: {self.average_mpsas:.2f} ", False),
+                  (f"Average Milky Way brightness: {self.average_mw_sb:.2f} ", False)]
+        top, others = self.common_intervals()
+        if top:
+            text = ", ".join(f"{value}s x {count}" for value, count in top)
+            if others:
+                text += f", {others} others"
+            lines.append((f"Measurement intervals: {text}", False))
+        if self.events:
+            lines.append(("Notes:", False))
+            lines += [(f"  {event}", False) for event in self.events]
+            if self.events_dropped:
+                lines.append((f"  ... and {self.events_dropped} more", False))
+        return lines
+
+    def to_text(self):
+        return "".join(f"{text}\n" for text, _ in self._lines())
+
+    def to_html(self):
+        """The text report with values escaped, for use inside <pre>"""
+        return "".join(f"<strong>{html.escape(text)}</strong>\n" if emphasized else f"{html.escape(text)}\n"
+                       for text, emphasized in self._lines())
 
 
 def process_stream(file_path, output_file_path, mpsas_limit, sun_max_alt=SUN_LIMIT_DEG, moon_max_alt=MOON_LIMIT_DEG,
                    roll_duration_min=DEFAULT_ROLL_DURATION_MIN,
-                   stdev_threshold=DEFAULT_STDEV_THRESHOLD, mw_sb_threshold=MW_SB_THRESHOLD, testmode=0, mpsas_high_limit=MPSAS_HIGH_LIMIT):
+                   stdev_threshold=DEFAULT_STDEV_THRESHOLD, mw_sb_threshold=MW_SB_THRESHOLD, testmode=0, mpsas_high_limit=MPSAS_HIGH_LIMIT,
+                   engine=None, progress=None, output_format=None):
+    """
+    Filter an SQM .dat file and write the accepted lines to output_file_path, in
+    output_format (see OUTPUT_FORMATS, default OUTPUT_FORMAT).
+    progress: optional callable, called as progress(phase, lines_processed=..., used_lines=...,
+    cache_hits=..., cache_misses=...) when a phase starts and after every chunk read. The
+    "write" phase also passes nights=night_averages(rows), before the file is written. The
+    filter decides all lines in one pass, so the nights of the whole file come together
+    then, not one by one while filtering.
+    Returns (location_name, average_mpsas, serial_number, ProcessingReport, rows), rows being
+    the accepted lines as typed columns (see processed_rows).
+    """
     from astropy.time import Time
     from astropy.coordinates import EarthLocation, AltAz, get_sun, get_body
     import astropy.units as u
@@ -358,25 +1726,21 @@ def process_stream(file_path, output_file_path, mpsas_limit, sun_max_alt=SUN_LIM
 
 
     
-    output = "output:\n"
+    report = ProcessingReport({"mpsas_limit": mpsas_limit, "sun_max_alt": sun_max_alt, "moon_max_alt": moon_max_alt,
+                               "roll_duration_min": roll_duration_min, "stdev_threshold": stdev_threshold,
+                               "mpsas_high_limit": mpsas_high_limit, "mw_sb_threshold": mw_sb_threshold})
     #print(f"process_stream file: {file_path}")
     logging.debug(f"process_stream file: {file_path}")
-    #output = output + f"processing file: {file_path} \nwith params mpsas_limit {mpsas_limit} sun_max_alt {sun_max_alt} moon_max_alt {moon_max_alt} \nroll_duration_min {roll_duration_min} stdev_threshold {stdev_threshold}\n"
-    output = output + f"Processing file with params: \nmpsas_limit {mpsas_limit} \nsun_max_alt {sun_max_alt} \nmoon_max_alt {moon_max_alt} \nroll_duration_min {roll_duration_min} \nstdev_threshold {stdev_threshold}\nmpsas_high_limit {mpsas_high_limit}\nMilky Way brightness threshold: {mw_sb_threshold}\n"
     logging.debug(f"Processing file with params: \nmpsas_limit {mpsas_limit} \nsun_max_alt {sun_max_alt} \nmoon_max_alt {moon_max_alt} \nroll_duration_min {roll_duration_min} \nstdev_threshold {stdev_threshold}\nmpsas_high_limit {mpsas_high_limit}\nMilky Way brightness threshold: {mw_sb_threshold}")
 
-    buffer = deque()  # stores (Time, MPSAS)
     linecounter = 0
-    last_altitude_time = None
-    sun_alt = moon_alt = None
-    roll_duration_td = timedelta(minutes=roll_duration_min)
     total_mpsas = 0
     used_lines = 0
-    
-    last_timestamp = None
-    last_time_diff_min = 0
-    
-    last_milky_way_visible = False
+    cache_stats = {"cache_hits": 0, "cache_misses": 0}
+
+    def report_progress(phase, **partial):
+        if progress is not None:
+            progress(phase, lines_processed=linecounter, used_lines=used_lines, **cache_stats, **partial)
     
     line_limit = 10000000
     
@@ -386,45 +1750,35 @@ def process_stream(file_path, output_file_path, mpsas_limit, sun_max_alt=SUN_LIM
         file_path = "/srv/www/d9.pihl.net/public_html/sqm_processing/uploads/20240522_220724_DSMN-2.dat"
         logging.debug(f"testmode: {testmode}")
     
-    with open(file_path, "r", encoding="utf-8", errors="ignore") as f, \
-        open(output_file_path, "w") as out:
+    with open(file_path, "r", encoding="utf-8", errors="ignore") as f:
         logging.debug(f"reading file: {file_path}")
         milky_way_visible_count = 0 # counter for MW visible occurrences
         cloudy_count = 0
         sun_moon_lines_rejected = 0   
         mpsas_low_lines_rejected = 0    
         mpsas_high_lines_rejected = 0
+        bad_time_lines_rejected = 0
         # mpsas_high_limit_running = DEFAULT_MPSAS_HIGH_LIMIT
         mpsas_high_total = 0
         mpsas_ok_lines = 0
         
-        
-        # write header
-        out.write("UTC_TIME;LOCAL_TIME;SUN_ALT;MOON_ALT;MPSAS;MW_BRIGHTNESS;MW_VISIBLE;ROLL_STDEV\n")
-        ###                out.write(f"{utc_str};{local_str};{sun_alt:.3f};{moon_alt:.3f};{mpsas:.3f};{mw_sb:.2f};{milky_way_visible};{roll_stdev:.4f}\n")
+
 
         # parse header for location
         lat, lon, location_name, serial_number, header_len = parse_header(f)
+        report.lat, report.lon, report.location_name, report.header_lines = lat, lon, location_name, header_len
         if lat is None or lon is None:
             logging.debug(f"Could not extract location from header, using default 55N/12.5E")
             #print("Could not extract location from header, using default 55N/12E")
             location = EarthLocation(lat=55*u.deg, lon=12*u.deg)
-            output = output + f"<strong>Missing location, using default: {lat}:{lon}\n"
-            output = output + f"Sunrise, Sunset, Moonrise and Moonset times will not be precise</strong>\n"
         else:
             location = EarthLocation(lat=lat*u.deg, lon=lon*u.deg)
             logging.debug(f"Location from header: {lat}:{lon}")
-            output = output + f"Location: {lat}:{lon}\n"
             
-        
-        output = output + f"Location name: {location_name}\n"
         logging.debug(f"serial_number: {serial_number}")
         
             #print(f"Location: {lat}, {lon}")
         
-        
-        output = output + f"Header lines: {header_len}\n"
-        
             
             
         logging.debug(f"header_len: {header_len}")
@@ -445,256 +1799,130 @@ def process_stream(file_path, output_file_path, mpsas_limit, sun_max_alt=SUN_LIM
             line_limit = 100000000
 
         logging.debug(f"skipping headers: {header_len}")
-        prev_times = deque(maxlen=5)
         last_mpsas = 0.0
-        
-        total_mw_sb = 0
-        count_mw_sb = 0
                     
         logging.debug(f"Processing lines")
-        for line in f:
-            
-            linecounter += 1
-            line = line.strip()
-            # logging.debug(f"Line: {linecounter}: {line}")
-            
-            if not line:
-                continue
-            parts = line.split(";")
-            if len(parts) < 6:
-                logging.warning(f"Skipping malformed line {linecounter}: {line}")
-                continue
-                #UTC Date & Time, Local Date & Time, Temperature, Voltage, MSAS, Record type
-                #2024-03-19T16:07:05.000;
-                #2024-03-19T17:07:05.000;
-                #5.8;
-                #4.96;
-                #0.00;
-                #1
-            utc_str, local_str, temp, volt, mpsas_str, dtype = parts[:6]
-            if (linecounter%1000)==0:
-                logging.debug(f"Reading line {linecounter}")
-            try:
-                mpsas = float(mpsas_str)
-                
-                # track average mpsas for high rejection
-                
-                
-                if (abs(mpsas - last_mpsas) > 1.5 and last_mpsas > 0.0 and mpsas > 0.0):
-                    fileline = linecounter + header_len
-                    logging.debug(f"Large MPSAS jump at line {fileline}: {last_mpsas} -> {mpsas}")
-                last_mpsas = mpsas
-
-                if (mpsas < mpsas_limit ): # can be rejected already here
-                    mpsas_low_lines_rejected += 1
-                    # logging.debug(f"Rejected line {linecounter}: low mpsas:{mpsas} < {mpsas_limit}")
-                    continue
-                
-                if (mpsas > mpsas_high_limit):
-                    mpsas_high_lines_rejected += 1
-                    # logging.debug(f"Rejected line {linecounter}: high mpsas:{mpsas} > {mpsas_high_limit}")
-                    continue
-                    
-                    
-                # mpsas_ok_lines = mpsas_ok_lines + 1
-                # mpsas_high_total = mpsas_high_total + mpsas
-                
-                # # logging.debug(f"check mpsas:{mpsas} > {mpsas_limit}")
-                # if (mpsas_ok_lines > 0 and mpsas > MPSAS_HIGH_LIMIT):
-                #     logging.debug(f"mpsas_ok_lines: {mpsas_ok_lines}")
-                #     mpsas_running_average = mpsas_high_total/mpsas_ok_lines 
-                #     mpsas_high_limit_running = mpsas_running_average + 0.5
-                #     logging.debug(f"mpsas_high_limit from {mpsas_running_average}:  {mpsas_high_limit_running}")
-                    
-                # if (mpsas > mpsas_high_limit_running): # probably overcast
-                #     mpsas_high_lines_rejected += 1
-                #     logging.debug(f"reject high mpsas:{mpsas} > {mpsas_high_limit_running}")
-                #     continue
-                        
-                #logging.debug(f"mpsas {mpsas}")
-                t = parse_time(utc_str)
-                if t is None:
-                    logging.exception(f"Error parsing time in line {linecounter}")
-                    continue
-            except Exception:
-                logging.exception(f"Error parsing line {linecounter}")
-                continue
-            
-            
-            
-            # append to rolling buffer
-            #logging.debug(f"appending to buffer t mpsas {t} {mpsas}")
-            buffer.append((t, mpsas))
-            #logging.debug(f"cutoff calc")
-            cutoff = t - (roll_duration_min * u.min).to(u.day)
-            #cutoff = t - roll_duration_td.to(u.day)
-            #logging.debug(f"cutoff: {cutoff}")
-            buffer = deque([(tt, mm) for tt, mm in buffer if tt > cutoff])
-            #logging.debug(f"done appending to buffer and deque")
-            #logging.debug(f"going to check last_altitude_time and roll_duration_td")
-            
-            # update sun/moon altitudes only if elapsed > roll_duration_min
-            #logging.debug(f"checking last_altitude_time {last_altitude_time} ")
-            
- 
-
-
-    # parse timestamp into a datetime object
-            #ts = datetime.strptime(utc_str, "%Y-%m-%dT%H:%M:%S")
-            if last_timestamp is not None:
-                time_diff_min = (t.datetime - last_timestamp.datetime).total_seconds() / 60.0
-                logging.debug(f"time_diff_min: {time_diff_min}")
-                output = output + f"Measurement interval: {time_diff_min}\n"
-                #if(time_diff_min != last_time_diff_min):
-                roll_duration_min = 3 * time_diff_min
-                #logging.debug(f"time_diff_min={time_diff_min:.2f}, roll_duration_min={roll_duration_min:.2f}")
-            else:
-                roll_duration_min = DEFAULT_ROLL_DURATION_MIN
-            
-            if (debug > 0):
-                logging.debug(f"last_time_diff_min: {last_time_diff_min}")
-
-#             if (last_time_diff_min != time_diff_min):
-#              logging.debug(f"{time_diff_min} != {last_time_diff_min}")
-#                 time_diff_min = (t.datetime - last_timestamp.datetime).total_seconds() / 60.0
-#                 output = output + f"<strong>Changed measurement interval: {time_diff_min}</strong>\n"
-#                 #if(time_diff_min != last_time_diff_min):
-#                 roll_duration_min = 3 * time_diff_min
-            
-#             last_timestamp = t
-#             last_time_diff_min = time_diff_min
-
-#             if last_timestamp is not None:
-#                 time_diff_min = (t - last_timestamp).total_seconds() / 60
-#                 roll_duration_min = 3 * time_diff_min
-#                 logging.debug(f"time_diff_min: {time_diff_min:.2f}, roll_duration_min: {roll_duration_min:.2f}")
-#             else:
-#                 logging.debug("first timestamp, skipping diff")
-# 
-#             last_timestamp = t            
-#             #roll_duration_td = (roll_duration_min * u.min).to(u.day)
-# 
-#             logging.debug(f"roll_duration_td: {roll_duration_td}")
-#             roll_duration_min = (time_diff * u.min * 3).to(u.day)
-#             logging.debug(f"set roll_duration_min: {roll_duration_min}")
-            
-            if last_altitude_time is None or (t - last_altitude_time) > (roll_duration_min * u.min).to(u.day):
-                # First calculate sun altitude to check if it's below horizon
-                altaz = AltAz(obstime=t, location=location)
-                sun_alt = get_sun(t).transform_to(altaz).alt.deg
-                
-                # Only process when sun is below horizon (sun_alt < 0)
-                if sun_alt < 0:
-                    cache_result = get_cache(lat, lon, t)
-                    
-                    if cache_result:
-                        # Use cached values
-                        moon_alt = cache_result['moon_alt']
-                        mw_sb = cache_result['mw_brightness']
-                        
-                        
-                        
-                        # milky_way_visible = cache_result['milky_way_visible']
-                        # use value from input, not cache
-                        # milky_way_visible = (mw_sb <= mw_sb_threshold)
-                        # if milky_way_visible:
-                        #     milky_way_visible_count +=1
-                        # logging.debug(f"Using cached values: sun_alt={sun_alt:.2f}, moon_alt={moon_alt:.2f}, mw_sb={mw_sb:.2f}")
-                    else:
-                        # Calculate remaining values
-                        moon_alt = get_body("moon", t, location=location).transform_to(altaz).alt.deg
-                        
-                        # compute zenith direction and its galactic latitude
-                        zen_altaz = AltAz(obstime=t, location=location, alt=90*u.deg, az=0*u.deg)  # az arbitrary at zenith
-                        zenith = SkyCoord(zen_altaz)                     # create SkyCoord in AltAz then transform
-                        zenith_gal = zenith.transform_to('galactic')
-                        b_deg = abs(zenith_gal.b.deg)
-                        
-                        # scale base surface brightness by galactic latitude.
-                        # simple linear fade: at plane b=0 -> BASE_MW_SB_AT_PLANE
-                        # at poles b=90 -> BASE_MW_SB_AT_PLANE + PLANE_TO_POLE_FADE
-                        mw_sb_plane = BASE_MW_SB_AT_PLANE + (PLANE_TO_POLE_FADE * (b_deg / 90.0))
-                        
-                        # compute airmass for zenith direction (zenith angle = 90 - alt = 0 for zenith)
-                        # airmass at zenith is 1.0, but keep formula for completeness if you sample off-zenith
-                        zen_alt = 90.0 - 90.0   # zero
-                        airmass = 1.0
-                        
-                        # apply extinction
-                        mw_sb = mw_sb_plane + EXTINCTION_COEFF * (airmass - 1.0)
-                        
-                        # visible boolean
-                        # milky_way_visible = (mw_sb <= mw_sb_threshold)
-                        # if milky_way_visible:
-                        #     milky_way_visible_count +=1
-                        # Store in cache
-                        set_cache(lat, lon, t, sun_alt, moon_alt, mw_sb, milky_way_visible)
-                        
-                        # logging
-                        if (debug > 0):
-                            logging.debug(f"zenith b={b_deg:.2f}°, mw_sb_plane={mw_sb_plane:.2f}, mw_sb={mw_sb:.2f}, visible={milky_way_visible}")
-                    
 
-                    milky_way_visible = (mw_sb < mw_sb_threshold)
-                    if milky_way_visible:
-                        milky_way_visible_count +=1
-                    
-                    total_mw_sb += mw_sb
-                    count_mw_sb += 1
-
-
-                    if (milky_way_visible != last_milky_way_visible):
-                        last_milky_way_visible = milky_way_visible
-                        # logging.debug(f"change: milky_way_visible: {milky_way_visible}, mw_sb: {mw_sb:.2f} <> {mw_sb_threshold}")
-
-                    if (debug > 0):
-                        logging.debug(f"moon_alt: {moon_alt}")
-                        logging.debug(f"sun_alt: {sun_alt}")
-                # else:
-                    # Daytime (sun_alt >= 0): skip all calculations
-                    # logging.debug(f"Daytime (sun_alt={sun_alt:.2f}), skipping sky quality calculations")
-                
-                # last_altitude_time = t
-                last_altitude_time = None # force recalc sun_alt next time
-                    
-                    
-            # only calculate roll_stdev if both sun/moon are below limits
-            if sun_alt is not None and moon_alt is not None and \
-            sun_alt < sun_max_alt and moon_alt < moon_max_alt:
-                roll_stdev = np.std([mm for _, mm in buffer]) if len(buffer) >= 2 else np.nan
-                if not np.isnan(roll_stdev) and roll_stdev < stdev_threshold:
-                    
-                    #logging.debug(f"Line {linecounter}: roll_stdev {roll_stdev:.
-                    # output = output + f"Line {linecounter}: Accepted MPSAS {mpsas} with roll_stdev {roll_stdev:.4f}\n"
-                    if (not milky_way_visible): # added milky way not visible # removed mpsas > mpsas_limit because already checked 
-                        #logging.debug(f"mpsas: {mpsas} > {mpsas_limit}")
-                        out.write(f"{utc_str};{local_str};{sun_alt:.3f};{moon_alt:.3f};{mpsas:.3f};{mw_sb:.2f};{milky_way_visible};{roll_stdev:.4f}\n")
-                    #print(f"Output line: {utc_str};{local_str};{sun_alt:.3f};{moon_alt:.3f};{mpsas:.3f};{roll_stdev:.4f}")
-                        total_mpsas = total_mpsas + mpsas
-                        used_lines = used_lines + 1
-                        
-                        # keep maximum mpsas in file
-                        if mpsas > max_mpsas:
-                            max_mpsas = mpsas
-                    else:
-                        # logging.debug(f"change: milky_way_visible: {milky_way_visible}, mw_sb: {mw_sb:.2f} < {mw_sb_threshold}")
-                        logging.debug(f"Line {linecounter}: Rejected: milky_way_visible {milky_way_visible} mw_sb: {mw_sb:.2f} < {mw_sb_threshold}, mpsas {mpsas}")
-                        # output = output + f"Line {linecounter}: Rejected MPSAS {mpsas} due to limit {mpsas_limit} or milky_way_visible {milky_way_visible}\n"
-                else:
-                    cloudy_count += 1
-                    #logging.debug(f"Line {linecounter}: Rejected due to roll_stdev {roll_stdev:.4f}")
-                    # output = output + f"Line {linecounter}: Rejected MPSAS {mpsas} with roll_stdev {roll_stdev:.4f}\n"
-            else:
-                # sun_alt >= sun_max_alt or moon_alt >= moon_max_alt - conditions not met
-                sun_moon_lines_rejected += 1
-            
-            if (used_lines > line_limit):
-                logging.info(f"break after {linecounter} lines, used_lines {used_lines}")
-                output = output + f"Ending after {used_lines} good lines, because your device is not registered\n"
-                break    
-                
+        # ---- pass 1: read the body in column chunks and apply the MPSAS limits ----
+        # only lines that survive these checks reach the ephemeris step. Rejected lines and
+        # report notes are counted once the filter knows where the line limit stopped
+        kept = []
+        rejected = {"mpsas_low": [], "mpsas_high": [], "bad_time": []}  # line numbers per chunk
+        notes = []          # (line, message), the first report.max_events in line order
+        note_lines = []     # line numbers of all notes per chunk
+        report_progress("parse")
+        for chunk in read_sqm_chunks(f):
+            linecounter += chunk["lines_read"]
+            logging.debug(f"Read {linecounter} lines")
+            report_progress("parse")
+            line = chunk["line"]
+            mpsas = chunk["mpsas"]
+
+            unreadable = np.isnan(mpsas)
+            chunk_notes = []
+            for i in np.flatnonzero(unreadable):
+                logging.warning(f"Error parsing line {line[i]}: unreadable MPSAS value")
+                chunk_notes.append((line[i], f"Line {line[i]}: unreadable MPSAS value"))
+            readable = np.flatnonzero(~unreadable)
+
+            # log large jumps between consecutive readable values
+            values = mpsas[readable]
+            previous = np.concatenate([[last_mpsas], values[:-1]])
+            for j in np.flatnonzero((np.abs(values - previous) > 1.5) & (previous > 0.0) & (values > 0.0)):
+                logging.debug(f"Large MPSAS jump at line {line[readable[j]] + header_len}: {previous[j]} -> {values[j]}")
+            if len(values) > 0:
+                last_mpsas = values[-1]
+
+            low = ~unreadable & (mpsas < mpsas_limit)     # can be rejected already here
+            high = ~unreadable & ~low & (mpsas > mpsas_high_limit)
+            rejected["mpsas_low"].append(line[low])
+            rejected["mpsas_high"].append(line[high])
+
+            keep = np.flatnonzero(~unreadable & ~low & ~high)
+
+            # timestamps: the chunk's UTC column at once, malformed ones are rejected.
+            # Only datetime64 columns are kept, the text of the chunk is dropped here
+            utc_time = parse_time_column(chunk["utc"][keep])
+            bad = np.isnat(utc_time)
+            for i in np.flatnonzero(bad):
+                if bad_time_lines_rejected < 20:
+                    logging.warning(f"Rejected line {line[keep[i]]}: unreadable timestamp {chunk['utc'][keep[i]]!r}")
+                chunk_notes.append((line[keep[i]], f"Line {line[keep[i]]}: unreadable timestamp {chunk['utc'][keep[i]]!r}"))
+                bad_time_lines_rejected += 1
+            rejected["bad_time"].append(line[keep[bad]])
+            chunk_notes.sort(key=lambda note: note[0])
+            notes += chunk_notes[:report.max_events - len(notes)]
+            note_lines.append(np.array([note[0] for note in chunk_notes], dtype=int))
+            keep, utc_time = keep[~bad], utc_time[~bad]
+            kept.append({"line": line[keep], "utc_time": utc_time,
+                         "local_time": parse_time_column(chunk["local"][keep]), "mpsas": mpsas[keep]})
+
+        row_lines = np.concatenate([c["line"] for c in kept] or [np.empty(0, dtype=int)])
+        row_utc_time = np.concatenate([c["utc_time"] for c in kept] or [np.empty(0, dtype='datetime64[ms]')])
+        row_local_time = np.concatenate([c["local_time"] for c in kept] or [np.empty(0, dtype='datetime64[ms]')])
+        row_mpsas = np.concatenate([c["mpsas"] for c in kept] or [np.empty(0)])
+        del kept
+        # int64 seconds since 1970, fractional seconds truncated
+        row_seconds = row_utc_time.astype('datetime64[s]').astype(np.int64)
+
+        # ---- ephemeris: all timestamps of the file in one batch ----
+        logging.debug(f"Computing ephemeris for {len(row_seconds)} lines")
+        report_progress("ephemeris")
+        if len(row_seconds) > 0:
+            times = Time(row_seconds, format='unix', scale='utc')
+            sun_alts, moon_alts, mw_sbs = compute_file_ephemeris(times, location, stats=cache_stats)
+        else:
+            sun_alts = moon_alts = mw_sbs = np.empty(0)
+
+        # ---- pass 2: rolling stdev and accept/reject decisions ----
+        # the first line uses the requested window, the following lines the default one
+        row_seconds = row_seconds.astype(float)
+        roll_window_s = np.full(len(row_seconds), DEFAULT_ROLL_DURATION_MIN * 60.0)
+        roll_window_s[:1] = roll_duration_min * 60.0
+
+        engine = engine or FILTER_ENGINE
+        report_progress("filter")
+        logging.debug(f"Filtering {len(row_seconds)} lines with the {engine} engine")
+        result = FILTER_ENGINES[engine](row_seconds, row_mpsas, sun_alts, moon_alts, mw_sbs, roll_window_s,
+                                        sun_max_alt, moon_max_alt, stdev_threshold, mw_sb_threshold, line_limit)
+
+        milky_way_visible_count = result["milky_way_visible_count"]
+        cloudy_count = result["cloudy_count"]
+        sun_moon_lines_rejected = result["sun_moon_lines_rejected"]
+        used_lines = result["used_lines"]
+        total_mpsas = result["total_mpsas"]
+        max_mpsas = result["max_mpsas"]
+        total_mw_sb = result["total_mw_sb"]
+        count_mw_sb = result["count_mw_sb"]
+        report_progress("filter")
+
+        # accepted lines never have the Milky Way visible
+        idx = result["accepted"]
+        rows = processed_rows(row_utc_time[idx], row_local_time[idx], sun_alts[idx], result["moon_alt"], row_mpsas[idx],
+                              result["mw_sb"], np.zeros(len(idx), dtype=bool), result["roll_stdev"])
+        report.nights = night_averages(rows)
+        report_progress("write", nights=report.nights)
+
+        if result["stop"] is not None:
+            linecounter = int(row_lines[result["stop"]])
+            logging.info(f"break after {linecounter} lines, used_lines {used_lines}")
+            report.stopped_early = True
+
+        # like the line by line loop, count only what comes before the line limit stop
+        counted_rows = len(row_seconds) if result["stop"] is None else result["stop"] + 1
+        last_line = row_lines[result["stop"]] if result["stop"] is not None else np.inf
+        mpsas_low_lines_rejected, mpsas_high_lines_rejected, bad_time_lines_rejected = (
+            sum(int((lines <= last_line).sum()) for lines in rejected[k]) for k in ("mpsas_low", "mpsas_high", "bad_time"))
+        noted = sum(int((lines <= last_line).sum()) for lines in note_lines)
+        for line, message in notes[:noted]:
+            report.event(message)
+        report.events_dropped += noted - min(noted, len(notes))
+        report.add_intervals(row_seconds[:counted_rows])
+
+    OUTPUT_FORMATS[output_format or OUTPUT_FORMAT][2](output_file_path, rows)
     print(f"Finished processing {linecounter} lines, {used_lines} saved to {output_file_path}")
     logging.info(f"Finished processing {linecounter} lines, {used_lines} saved to {output_file_path}")
+    average_mw_sb = 0
     if (used_lines > 0):
         average_mpsas = total_mpsas/used_lines
         if (count_mw_sb > 0):
@@ -705,26 +1933,698 @@ def process_stream(file_path, output_file_path, mpsas_limit, sun_max_alt=SUN_LIM
     else:
         average_mpsas = 0
         logging.info(f"no lines for average_mpsas {average_mpsas}")
-    output = output + f"Finished processing {linecounter} lines\nAccepted lines {used_lines}\n"
-    output = output + f"Average MPSAS for {location_name}: {average_mpsas:.2f} \n"
-    # output = output + f"Maximum MPSAS {max_mpsas:.2f} \n"
-    output = output + f"Milky way brightness lines rejected: {milky_way_visible_count},  light < {mw_sb_threshold}\n"
-    output = output + f"Cloudy lines rejected (stdev > {stdev_threshold}): {cloudy_count} \n"
-    output = output + f"Sun/Moon altitude lines rejected: {sun_moon_lines_rejected} \n" 
-    # output = output + f"MPSAS low lines rejected (MPSAS < {mpsas_limit}): {mpsas_low_lines_rejected} \n"
-    output = output + f"MPSAS high lines rejected: {mpsas_high_lines_rejected}, (MPSAS > {mpsas_high_limit}) \n"
+    report.counters.update({
+        "lines_processed": linecounter,
+        "accepted_lines": used_lines,
+        "mw_rejected": milky_way_visible_count,
+        "cloudy_rejected": cloudy_count,
+        "sun_moon_rejected": sun_moon_lines_rejected,
+        "mpsas_low_rejected": mpsas_low_lines_rejected,
+        "mpsas_high_rejected": mpsas_high_lines_rejected,
+        "bad_time_rejected": bad_time_lines_rejected,
+    })
+    report.average_mpsas = average_mpsas
+    report.average_mw_sb = average_mw_sb
     logging.info(f"Average MPSAS for {location_name}: average_mpsas: {average_mpsas:.2f} max_mpsas: MPSAS: {max_mpsas:.2f} ")
-    output = output + f"Average MPSAS for {location_name}: {average_mpsas:.2f} \n"
-    # output = output + f"Maximum MPSAS {max_mpsas:.2f} \n"
-    
-    output = output + f"Average Milky Way brightness: {average_mw_sb:.2f} \n"
     
     logging.info(f"Milky way visible rejected {milky_way_visible_count}, brightness > {mw_sb_threshold}\n")
     logging.info(f"cloudy rejected {cloudy_count} \n")
     logging.info(f"sun/moon alt rejected {sun_moon_lines_rejected} \n")
     logging.info(f"MPSAS low lines rejected {mpsas_low_lines_rejected} \n")
     logging.info(f"MPSAS high lines rejected {mpsas_high_lines_rejected}, MPSAS > {mpsas_high_limit} \n")
-    return location_name, average_mpsas, serial_number, output
+    logging.info(f"unreadable timestamp lines rejected {bad_time_lines_rejected} \n")
+    return location_name, average_mpsas, serial_number, report, rows
+
+
+
+# ==================== PLOTTING ====================
+# Plots are drawn on their own Figure with the Agg canvas, never through pyplot's global
+# state, so renders in different threads can't interleave. matplotlib is imported on the
+# first plot, not when the service starts.
+
+_plot_modules = None
+_plot_modules_lock = threading.Lock()
+
+
+def plot_modules():
+    """matplotlib's Figure class and Agg canvas, imported on first use"""
+    global _plot_modules
+    with _plot_modules_lock:
+        if _plot_modules is None:
+            import matplotlib
+            matplotlib.rcParams['font.family'] = 'DejaVu Sans'  # or 'Liberation Sans', 'Arial', etc.
+            matplotlib.rcParams['font.sans-serif'] = ['DejaVu Sans']
+            from matplotlib.figure import Figure
+            from matplotlib.backends.backend_agg import FigureCanvasAgg
+            _plot_modules = (Figure, FigureCanvasAgg)
+    return _plot_modules
+
+
+def decimate_minmax(x, y, columns):
+    """
+    Indices of the points to draw for a series of (x, y) on a plot columns pixels wide:
+    the first, last, lowest and highest y in every pixel column of x, in the original
+    order (M4 aggregation). The line then looks the same as with all points, including
+    the extremes, and drawing costs at most 4 * columns points. Points with a non-finite
+    x or y are left out.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    finite = np.flatnonzero(np.isfinite(x) & np.isfinite(y))
+    if len(finite) <= 4 * columns:
+        return finite
+    xf = x[finite]
+    span = xf.max() - xf.min()
+    column = np.zeros(len(finite), dtype=np.int64) if span == 0 else \
+        np.minimum(((xf - xf.min()) / span * columns).astype(np.int64), columns - 1)
+    keep = []
+    for order in (np.argsort(column, kind="stable"),  # by column, then position
+                  np.lexsort((y[finite], column))):   # by column, then y
+        starts = np.flatnonzero(np.r_[True, np.diff(column[order]) != 0])
+        ends = np.r_[starts[1:], len(order)] - 1
+        keep += [order[starts], order[ends]]
+    return finite[np.unique(np.concatenate(keep))]
+
+
+def render_plot(rows, png_file, location_name):
+    """
+    Plot MPSAS and Milky Way brightness to png_file. rows are the columns returned by
+    process_stream, or the path of a processed CSV file to read them from.
+    """
+    if isinstance(rows, (str, Path)):
+        logging.debug(f"reading data {rows}")
+        csv_file = Path(rows)
+        try:
+            csv_file.resolve(strict=True)
+        except FileNotFoundError:
+            logging.debug(f"cant find {csv_file}")
+            return False
+        rows = read_processed_csv(csv_file)
+
+    Figure, FigureCanvasAgg = plot_modules()
+    fig = Figure(figsize=(10, 10))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+
+    # large files: draw only the min/max of every pixel column, see decimate_minmax
+    local_time = rows["local_time"]
+    columns = int(fig.get_figwidth() * fig.dpi)
+    x = local_time.astype(np.int64) if not np.isnat(local_time).any() else np.arange(len(local_time))
+    mpsas_rows = decimate_minmax(x, rows["mpsas"], columns)
+    mw_rows = decimate_minmax(x, rows["mw_sb"], columns)
+    logging.debug(f"plotting {len(mpsas_rows)} of {len(local_time)} points")
+
+    ax.plot(local_time[mpsas_rows], rows["mpsas"][mpsas_rows], marker="o", linestyle="dotted", color="skyblue", label='MPSAS')
+    logging.debug(f"has plotted mpsas data")
+    #ax.plot(df["LOCAL_TIME"], df["MOON_ALT_SCALED"], marker="o", linestyle="none", color="orange", label='Moon alt')
+    #ax.plot(df["LOCAL_TIME"], df["SUN_ALT_SCALED"], marker="o", linestyle="none", color="gold", label='Sun alt')
+    ax.plot(local_time[mw_rows], rows["mw_sb"][mw_rows], marker="o", linestyle="dotted", color="orange", label='MW brightness')
+    ax.set_xlabel("Local Time")
+    ax.set_ylabel("MPSAS")
+    ax.set_title(f"SQM MPSAS over time at {location_name}")
+
+    ax.grid(True)
+    fig.tight_layout()
+    ax.legend(loc="lower right")
+
+    logging.debug(f"saving plot {png_file}")
+    fig.savefig(png_file)
+    return True
+
+
+def process_upload(save_path, processed_filename, params, testmode=0, progress=None, cache_key=None):
+    """
+    Process an uploaded file and render its plot. Runs in a worker process, so it only
+    takes and returns plain picklable values. The outputs go to their own directory under
+    RESULT_CACHE_DIR, named cache_key so that identical uploads can reuse them, or a
+    random name when the result is not to be cached.
+    """
+    result_name = cache_key or uuid.uuid4().hex
+    work_dir = os.path.join(RESULT_CACHE_DIR, f"{result_name}.{uuid.uuid4().hex[:8]}.tmp")
+    os.makedirs(work_dir)
+    processed_path = os.path.join(work_dir, processed_filename)
+    try:
+        location_name, average_mpsas, serial_number, report, rows = process_stream(
+            save_path, processed_path, params["mpsas_limit"], params["sun_max_alt"], params["moon_max_alt"],
+            params["roll_duration"], params["stdev_threshold"], params["mw_sb_threshold"], testmode,
+            params["mpsas_high_limit"], progress=progress, output_format=params.get("output_format"))
+    finally:
+        # the upload is only read here, what is kept of it is the result directory
+        remove_upload(save_path)
+    logging.debug(f"location_name {location_name}")
+    logging.debug(f"average_mpsas {average_mpsas:.2f}")
+    logging.debug(f"serial_number {serial_number}")
+
+    logging.debug(f"making plot")
+    if progress is not None:
+        progress("plot")
+    processed_file = processed_path
+    plot_rows = rows
+    png_file = f"{processed_path}.png"
+    test_files = {}
+
+    if testmode > 0:
+        logging.debug(f"testmode {testmode}")
+        randomnumber = random.randint(10, 2000)
+        processed_file = os.path.join(DOWNLOAD_DIR, "processed_20240522_220724_DSMN-2.dat")
+        plot_rows = processed_file
+        png_file = os.path.join(DOWNLOAD_DIR, "test.png")
+        test_files = {"processed_file": processed_file, "png_file": png_file,
+                      "png_url": f"/sqm_processing/downloads/test.png?{randomnumber}"}
+
+    render_plot(plot_rows, png_file, location_name)
+    job = publish_result(work_dir, result_name, {
+        "location_name": location_name,
+        "average_mpsas": float(average_mpsas),
+        "serial_number": serial_number,
+        "result": report.to_html(),
+        "report": report.to_dict(),
+        "processed_filename": processed_filename,
+        "output_format": params.get("output_format") or OUTPUT_FORMAT,
+    })
+    job.update(test_files)
+    return job
+
+
+def result_html(job, res):
+    """HTML result page for a finished upload"""
+    location_name = job["location_name"]
+    processed_filename = job["processed_filename"]
+    download_url = job["download_url"]
+    #({lat}, {lon})
+    return f"""
+        <html>
+            <head><title>SQM Processing Result</title></head>
+            <body>
+                
+                <h2>SQM MPSAS processing results for {location_name} </h2>
+                <h4>Average MPSAS for the period: {job["average_mpsas"]:.2f}</h4>
+                <strong>Serial number: {job["serial_number"]}</strong>
+                <pre>{res}</pre>
+                <p>
+                <img src="{job["png_url"]}">
+                </p>
+                <p>File saved as: <strong>{processed_filename}</strong></p>
+                <p><a href="{download_url}" target="_blank">Download processed file</a></p>
+            </body>
+        </html>
+        """
+
+
+# ==================== RESULT CACHE ====================
+# Every processed upload gets a directory RESULT_CACHE_DIR/<name> with its processed file,
+# its plot and result.json (the job dict without paths). For cacheable uploads the name is
+# result_cache_key(), so a re-upload of the same bytes with the same parameters is answered
+# from the directory without processing. Results are built in a .tmp directory and renamed
+# into place, so concurrent uploads never write into each other's files.
+
+RESULT_CACHE_INDEX = "result.json"
+RESULT_CACHE_KEY_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+# configuration that changes processed results, part of every key
+RESULT_CACHE_SETTINGS = (
+    "DEFAULT_ROLL_DURATION_MIN", "DEFAULT_LAT", "DEFAULT_LONG",
+    "BASE_MW_SB_AT_PLANE", "PLANE_TO_POLE_FADE", "EXTINCTION_COEFF",
+    "MW_MODEL", "MW_BEAM_FWHM_DEG", "MW_BEAM_RINGS", "MW_BEAM_AZIMUTHS", "MW_BEAM_STEP_S",
+    "EPHEMERIS_MODE", "EPHEMERIS_MAX_ERROR_DEG", "EPHEMERIS_MIN_GRID_STEP_S", "EPHEMERIS_TABLE_PATH",
+    "CACHE_TIME_BUCKET_MIN", "LIMIT_SERIALS", "ALLOWED_SERIALS",
+    "REPORT_MAX_EVENTS", "REPORT_MAX_INTERVALS",
+)
+
+
+def result_cache_key(upload_sha256, params):
+    """Key of a result: the upload's bytes, every form parameter and the settings that change the output"""
+    material = {
+        "upload": upload_sha256,
+        "params": params,
+        "version": RESULT_CACHE_VERSION,
+        "settings": {name: globals()[name] for name in RESULT_CACHE_SETTINGS},
+    }
+    return hashlib.sha256(json.dumps(material, sort_keys=True).encode()).hexdigest()
+
+
+def upload_cache_key(upload_sha256, params, testmode=0):
+    """result_cache_key for an upload, None when its result is not to be cached"""
+    if not RESULT_CACHE_ENABLED or testmode > 0:
+        return None
+    return result_cache_key(upload_sha256, params)
+
+
+def with_result_paths(job, name):
+    """Job dict with the paths and URLs of the files in result directory name"""
+    job = dict(job)
+    directory = os.path.join(RESULT_CACHE_DIR, name)
+    url = f"/sqm_processing/downloads/results/{name}/{job['processed_filename']}"
+    job.update({
+        "processed_file": os.path.join(directory, job["processed_filename"]),
+        "png_file": os.path.join(directory, f"{job['processed_filename']}.png"),
+        "png_url": f"{url}.png",
+        "download_url": url,
+    })
+    return job
+
+
+def cached_result(key):
+    """Job dict of a stored result, None if there is none; marks it as recently used"""
+    if not RESULT_CACHE_KEY_PATTERN.match(key):
+        return None
+    index = os.path.join(RESULT_CACHE_DIR, key, RESULT_CACHE_INDEX)
+    try:
+        with open(index) as f:
+            job = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+    try:
+        os.utime(index)
+    except OSError as e:
+        logging.warning(f"Could not mark result {key} as used: {e}")
+    return with_result_paths(job, key)
+
+
+def publish_result(work_dir, name, job):
+    """
+    Move a finished result from work_dir to its place in RESULT_CACHE_DIR and return the
+    job dict with its paths. When an identical upload got there first, its files are kept.
+    """
+    with open(os.path.join(work_dir, RESULT_CACHE_INDEX), "w") as f:
+        json.dump(job, f)
+    try:
+        os.rename(work_dir, os.path.join(RESULT_CACHE_DIR, name))
+    except OSError:
+        logging.debug(f"Result {name} already stored, discarding {work_dir}")
+        shutil.rmtree(work_dir, ignore_errors=True)
+    evict_result_cache()
+    return with_result_paths(job, name)
+
+
+def evict_result_cache(max_bytes=None):
+    """
+    Remove the least recently used results until RESULT_CACHE_DIR holds at most max_bytes
+    (default RESULT_CACHE_MAX_BYTES). Unfinished .tmp directories older than an hour are
+    left over from failed jobs and go as well. Returns the bytes kept.
+    """
+    max_bytes = RESULT_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    now = time.time()
+    entries = []
+    total = 0
+    for entry in os.scandir(RESULT_CACHE_DIR):
+        try:
+            if not entry.is_dir():
+                continue
+            if entry.name.endswith(".tmp"):
+                if now - entry.stat().st_mtime > 3600:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                continue
+            used = os.stat(os.path.join(entry.path, RESULT_CACHE_INDEX)).st_mtime
+            size = sum(f.stat().st_size for f in os.scandir(entry.path) if f.is_file())
+        except FileNotFoundError:
+            continue        # removed by another worker meanwhile
+        entries.append((used, size, entry.path))
+        total += size
+
+    for used, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        logging.info(f"Result cache over {max_bytes} bytes, removing {path}")
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+    return total
+
+
+# ==================== WORKER POOL ====================
+# Processing and plotting are CPU bound, they run in a process pool so the event loop
+# keeps serving other requests. At most PROCESS_POOL_WORKERS + PROCESS_QUEUE_LIMIT
+# uploads are accepted at a time, further uploads get 503 with Retry-After.
+# Workers are spawned, not forked, so each one imports this module and opens its own
+# MySQL connection instead of sharing the parent's socket.
+
+_process_pool = None
+_pool_slots = threading.BoundedSemaphore(PROCESS_POOL_WORKERS + PROCESS_QUEUE_LIMIT)
+
+
+def get_process_pool():
+    """Return the process pool, (re)creating it when needed"""
+    global _process_pool
+    if _process_pool is None:
+        logging.info(f"Starting process pool with {PROCESS_POOL_WORKERS} workers")
+        _process_pool = ProcessPoolExecutor(max_workers=PROCESS_POOL_WORKERS,
+                                            mp_context=multiprocessing.get_context("spawn"))
+    return _process_pool
+
+
+def shutdown_process_pool():
+    global _process_pool
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=False, cancel_futures=True)
+        _process_pool = None
+
+
+def acquire_pool_slot():
+    """Reserve room for one job, False when the pool and its queue are full"""
+    return _pool_slots.acquire(blocking=False)
+
+
+def release_pool_slot():
+    _pool_slots.release()
+
+
+def submit_to_pool(func, *args):
+    """
+    Submit func(*args) to the process pool and return the concurrent future. The caller
+    must hold a slot from acquire_pool_slot(); it is released when the job finishes, also
+    when nobody is waiting for the result any more.
+    """
+    global _process_pool
+    try:
+        try:
+            future = get_process_pool().submit(func, *args)
+        except BrokenProcessPool:
+            # a worker died (e.g. out of memory), start a fresh pool
+            logging.warning("Process pool broken, restarting")
+            _process_pool = None
+            future = get_process_pool().submit(func, *args)
+    except Exception:
+        release_pool_slot()
+        raise
+    future.add_done_callback(lambda f: release_pool_slot())
+    return future
+
+
+async def run_in_pool(func, *args):
+    """Run func(*args) in the process pool and await the result, see submit_to_pool()"""
+    return await asyncio.wrap_future(submit_to_pool(func, *args))
+
+
+def busy_response():
+    """503 response telling the client to come back later"""
+    logging.info(f"All {PROCESS_POOL_WORKERS} workers busy and queue full, rejecting upload")
+    return JSONResponse(
+        status_code=503,
+        content={"status": "busy", "detail": "Server is busy processing other files, please try again shortly"},
+        headers={"Retry-After": str(PROCESS_RETRY_AFTER_S)}
+    )
+
+
+def upload_path(filename):
+    """Where to save an upload; unique, so uploads with the same name don't overwrite each other"""
+    return os.path.join(UPLOAD_DIR, f"{uuid.uuid4().hex[:12]}_{filename}")
+
+
+def remove_upload(save_path):
+    """Delete a saved upload once it is no longer needed"""
+    try:
+        os.remove(save_path)
+    except FileNotFoundError:
+        pass
+
+
+async def save_upload(file, save_path):
+    """Stream an uploaded file to disk in chunks, returns its size and SHA-256 hex digest"""
+    digest = hashlib.sha256()
+    with open(save_path, "wb") as f:
+        while chunk := await file.read(1024*1024):  # 1 MB chunks
+            f.write(chunk)
+            digest.update(chunk)
+    return os.path.getsize(save_path), digest.hexdigest()
+
+
+# ==================== JOBS ====================
+# Large files are submitted as jobs: POST /jobs returns a job id at once, the worker
+# writes the job state to JOBS_DIR/<job_id>.json while it runs and GET /jobs/<job_id>
+# reads it back. The state is a file so that any worker process can update it.
+# State files are removed JOB_STATUS_MAX_AGE_S after their last update (expire_job_status).
+# A job can outlive its result files, which the result cache may evict at any time.
+
+JOB_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+
+def job_status_path(job_id):
+    return os.path.join(JOBS_DIR, f"{job_id}.json")
+
+
+def write_job_status(job_id, status):
+    """Replace the stored state of a job (atomic, readers never see a partial file)"""
+    path = job_status_path(job_id)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(status, f)
+    os.replace(tmp_path, path)
+
+
+def read_job_status(job_id):
+    """Stored state of a job, None for unknown ids"""
+    if not JOB_ID_PATTERN.match(job_id):
+        return None
+    try:
+        with open(job_status_path(job_id)) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def expire_job_status(max_age_s=None):
+    """
+    Remove job state files (and leftover .tmp files) not written for max_age_s seconds,
+    default JOB_STATUS_MAX_AGE_S. Returns the number of files removed.
+    """
+    max_age_s = JOB_STATUS_MAX_AGE_S if max_age_s is None else max_age_s
+    now = time.time()
+    removed = 0
+    for entry in os.scandir(JOBS_DIR):
+        try:
+            if entry.is_file() and entry.name.endswith((".json", ".tmp")) and now - entry.stat().st_mtime > max_age_s:
+                os.remove(entry.path)
+                removed += 1
+        except FileNotFoundError:
+            continue        # removed by another process meanwhile
+    if removed:
+        logging.info(f"Removed {removed} job state files older than {max_age_s}s")
+    return removed
+
+
+class JobProgress:
+    """
+    Progress callback for process_stream that stores the phase and counters in the job
+    state. Writes are limited to one per JOB_PROGRESS_INTERVAL_S unless the phase changes.
+    """
+
+    def __init__(self, job_id, status):
+        self.job_id = job_id
+        self.status = status
+        self.last_write = 0.0
+
+    def __call__(self, phase, **counters):
+        now = time.time()
+        changed = phase != self.status.get("phase")
+        self.status.update(counters)
+        self.status["phase"] = phase
+        if changed or now - self.last_write >= JOB_PROGRESS_INTERVAL_S:
+            self.status["updated"] = now
+            write_job_status(self.job_id, self.status)
+            self.last_write = now
+
+
+def run_job(job_id, save_path, processed_filename, params, testmode=0, cache_key=None):
+    """Worker side of a job: process the upload and record the outcome in the job state"""
+    status = read_job_status(job_id) or {"job_id": job_id}
+    status.update({"status": "running", "phase": None, "started": time.time()})
+    write_job_status(job_id, status)
+    progress = JobProgress(job_id, status)
+    try:
+        job = process_upload(save_path, processed_filename, params, testmode, progress=progress, cache_key=cache_key)
+    except Exception as e:
+        logging.error(f"Job {job_id} failed: {e}")
+        status.update({"status": "error", "detail": str(e), "traceback": traceback.format_exc(),
+                       "finished": time.time()})
+        write_job_status(job_id, status)
+        return status
+    status.update({"status": "done", "phase": "done", "finished": time.time(), "result": job})
+    write_job_status(job_id, status)
+    return status
+
+
+def fail_job(job_id, detail, tb=None):
+    """Record a job as failed from the web process, for failures the worker can't record itself"""
+    logging.error(f"Job {job_id} failed: {detail}")
+    status = read_job_status(job_id) or {"job_id": job_id}
+    status.update({"status": "error", "detail": detail, "finished": time.time()})
+    if tb:
+        status["traceback"] = tb
+    write_job_status(job_id, status)
+
+
+def watch_job(job_id, save_path, future):
+    """
+    Mark the job as failed when its future ends without a result: the worker process died
+    (killed for memory, BrokenProcessPool) or the pool was shut down before it ran.
+    run_job records ordinary processing errors itself.
+    """
+    def done(f):
+        if f.cancelled():
+            detail = "job cancelled, the service was stopped"
+        elif f.exception() is not None:
+            detail = f"worker process failed: {f.exception()!r}"
+        else:
+            return
+        remove_upload(save_path)
+        fail_job(job_id, detail)
+
+    future.add_done_callback(done)
+
+
+@app.post("/jobs")
+async def submit_job(
+    file: UploadFile = File(...),
+    roll_duration: int = Form(DEFAULT_ROLL_DURATION_MIN),
+    stdev_threshold: float = Form(DEFAULT_STDEV_THRESHOLD),
+    moon_max_alt: int = Form(-10),
+    sun_max_alt: int = Form(-20),
+    mpsas_limit: float = Form(MPSAS_LIMIT),
+    mpsas_high_limit: float = Form(MPSAS_HIGH_LIMIT),
+    mw_sb_threshold: float = Form(MW_SB_THRESHOLD),
+    testmode: int = Form(TESTMODE),
+    output_format: str = Form(OUTPUT_FORMAT)
+):
+    """Start processing an upload in the background, returns the job id at once"""
+    error = output_format_error(output_format)
+    if error:
+        return JSONResponse(status_code=400, content={"status": "error", "detail": error})
+    if not acquire_pool_slot():
+        return busy_response()
+    expire_job_status()
+
+    job_id = uuid.uuid4().hex
+    filename = os.path.basename(file.filename)
+    save_path = upload_path(filename)
+    processed_filename = processed_file_name(filename, output_format)
+    try:
+        size, digest = await save_upload(file, save_path)
+        params = {
+            "mpsas_limit": mpsas_limit,
+            "sun_max_alt": sun_max_alt,
+            "moon_max_alt": moon_max_alt,
+            "roll_duration": roll_duration,
+            "stdev_threshold": stdev_threshold,
+            "mw_sb_threshold": mw_sb_threshold,
+            "mpsas_high_limit": mpsas_high_limit,
+            "output_format": output_format,
+        }
+        status = {"job_id": job_id, "status": "queued", "phase": None,
+                  "filename": filename, "size_bytes": size, "submitted": time.time(),
+                  "lines_processed": 0, "used_lines": 0, "cache_hits": 0, "cache_misses": 0}
+        cache_key = upload_cache_key(digest, params, testmode)
+        job = cached_result(cache_key) if cache_key else None
+        if job is not None:
+            status.update({"status": "done", "phase": "done", "finished": time.time(), "cached": True,
+                           "used_lines": job["report"]["counters"]["accepted_lines"],
+                           "lines_processed": job["report"]["counters"]["lines_processed"], "result": job})
+        write_job_status(job_id, status)
+    except Exception:
+        release_pool_slot()
+        raise
+    if job is not None:
+        release_pool_slot()
+        remove_upload(save_path)
+        logging.info(f"Job {job_id} for {filename} answered from the result cache")
+    else:
+        try:
+            future = submit_to_pool(run_job, job_id, save_path, processed_filename, params, testmode, cache_key)
+        except Exception as e:
+            fail_job(job_id, f"could not start the job: {e}", traceback.format_exc())
+            remove_upload(save_path)
+            return JSONResponse(status_code=500, content={"status": "error", "job_id": job_id, "detail": str(e)})
+        watch_job(job_id, save_path, future)
+        logging.info(f"Job {job_id} submitted for {filename}, {size} bytes")
+    return JSONResponse(
+        status_code=202,
+        content={"job_id": job_id, "status_url": f"/sqm_processing/jobs/{job_id}",
+                 "result_url": f"/sqm_processing/jobs/{job_id}/result"}
+    )
+
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    """Current state of a job: status, phase and counters"""
+    status = read_job_status(job_id)
+    if status is None:
+        return JSONResponse(status_code=404, content={"status": "error", "detail": "unknown job"})
+    status = {k: v for k, v in status.items() if k != "result"}
+    return JSONResponse(content=status)
+
+
+def job_event(status):
+    """Server-sent event for a job state: progress while it runs, then done or error"""
+    data = {k: v for k, v in status.items() if k not in ("result", "traceback")}
+    event = status["status"] if status["status"] in ("done", "error") else "progress"
+    if event == "done":
+        job = status["result"]
+        data.update({"location_name": job["location_name"], "average_mpsas": job["average_mpsas"],
+                     "serial_number": job["serial_number"], "png_url": job["png_url"],
+                     "download_url": job["download_url"],
+                     "result_url": f"/sqm_processing/jobs/{status['job_id']}/result"})
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(job_id: str):
+    """
+    The job state as a stream of server-sent events: one 'progress' event per change
+    (phase and counters), then 'done' or 'error'. The per-night averages of the whole file
+    are sent once, with the 'write' phase after filtering has finished.
+    """
+    if read_job_status(job_id) is None:
+        return JSONResponse(status_code=404, content={"status": "error", "detail": "unknown job"})
+
+    async def events():
+        last = None
+        last_sent = time.time()
+        while True:
+            status = read_job_status(job_id)
+            if status is None:
+                return
+            key = (status["status"], status.get("phase"), status.get("updated"))
+            if key != last:
+                last = key
+                last_sent = time.time()
+                yield job_event(status)
+                if status["status"] in ("done", "error"):
+                    return
+            elif time.time() - last_sent >= JOB_EVENTS_KEEPALIVE_S:
+                last_sent = time.time()
+                yield ": keep-alive\n\n"
+            await asyncio.sleep(JOB_EVENTS_POLL_S)
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.get("/jobs/{job_id}/result")
+async def job_result(job_id: str, format: str = Query("html", description="html, json, file (csv is an alias) or png")):
+    """Result of a finished job as the HTML page, the structured report, the processed file or the plot"""
+    status = read_job_status(job_id)
+    if status is None:
+        return JSONResponse(status_code=404, content={"status": "error", "detail": "unknown job"})
+    if status["status"] == "error":
+        return JSONResponse(status_code=500, content={"status": "error", "detail": status.get("detail")})
+    if status["status"] != "done":
+        return JSONResponse(status_code=409, content={"status": status["status"], "phase": status.get("phase"),
+                                                      "detail": "job not finished"},
+                            headers={"Retry-After": "5"})
+
+    job = status["result"]
+    if format in ("file", "csv", "png"):
+        path = job["png_file"] if format == "png" else job["processed_file"]
+        if not os.path.exists(path):
+            return JSONResponse(status_code=410, content={"status": "error",
+                                                          "detail": "result expired, upload the file again"})
+    if format in ("file", "csv"):
+        media_type = OUTPUT_FORMATS[job.get("output_format", "csv")][1]
+        return FileResponse(job["processed_file"], media_type=media_type, filename=job["processed_filename"])
+    if format == "png":
+        return FileResponse(job["png_file"], media_type="image/png")
+    if format == "json":
+        return JSONResponse(content=job["report"])
+    res = f"Received file: {html.escape(status['filename'])}, size={status['size_bytes']} bytes\n" + job["result"]
+    return HTMLResponse(content=result_html(job, res), status_code=200)
 
 
 @app.post("/process")
@@ -737,7 +2637,8 @@ async def process_file(
     mpsas_limit: float = Form(MPSAS_LIMIT),
     mpsas_high_limit: float = Form(MPSAS_HIGH_LIMIT),
     mw_sb_threshold: float = Form(MW_SB_THRESHOLD),
-    testmode: int = Form(TESTMODE)
+    testmode: int = Form(TESTMODE),
+    output_format: str = Form(OUTPUT_FORMAT)
 ):   
 
 #    global testmode
@@ -745,166 +2646,51 @@ async def process_file(
 # async def process_file(file: UploadFile = File(...), sun_max_alt: int = Query(SUN_LIMIT_DEG, description="Sun max altitude"), moon_max_alt: int = Query(MOON_LIMIT_DEG, description="Moon max altitude"), roll_duration: int = Query(DEFAULT_ROLL_DURATION_MIN, description="Rolling window duration in minutes"), stdev_threshold: float = Query(DEFAULT_STDEV_THRESHOLD, description="Max rolling stdev for MPSAS"), mpsas_limit: float = Query(MPSAS_LIMIT, description="Minimum MPSAS") ):
     
     logging.debug(f"/process mpsas_limit {mpsas_limit} sun_max_alt {sun_max_alt} testmode {testmode}")
+
+    error = output_format_error(output_format)
+    if error:
+        return JSONResponse(status_code=400, content={"status": "error", "detail": error})
+
+    # refuse before reading the upload when there is no room for it
+    if not acquire_pool_slot():
+        return busy_response()
+
+    save_path = None
+    slot_held = True     # until the job is handed to submit_to_pool, which releases it
     try:
-        save_path = os.path.join(UPLOAD_DIR, file.filename)
-        processed_filename = f"processed_{file.filename}"
-        processed_path = os.path.join(DOWNLOAD_DIR, processed_filename)
-        #processed_path = os.path.join(DOWNLOAD_DIR, f"processed_{file.filename}")
-        # Stream file to disk in chunks
-        with open(save_path, "wb") as f:
-            while chunk := await file.read(1024*1024):  # 1 MB chunks
-                f.write(chunk)
+        filename = os.path.basename(file.filename)
+        save_path = upload_path(filename)
+        processed_filename = processed_file_name(filename, output_format)
+        size, digest = await save_upload(file, save_path)
 
         # Debug: confirm upload
-        size = os.path.getsize(save_path)
-        res = f"Received file: {file.filename}, size={size} bytes\n"
-        #print(f"Received file: {file.filename}, size={size} bytes, saved at {save_path}")
-        
-#process_stream(file_path, output_file_path, mpsas_limit=MPSAS_LIMIT, sun_max_alt=SUN_LIMIT_DEG, moon_max_alt=MOON_LIMIT_DEG,
-#                   roll_duration_min=DEFAULT_ROLL_DURATION_MIN,
-#                   stdev_threshold=DEFAULT_STDEV_THRESHOLD):
-        # TODO: replace with your SQM processing logic
-        # You can open save_path and process line by line or in chunks
-        
-        
-        location_name, average_mpsas, serial_number, result = process_stream(save_path, processed_path, mpsas_limit, sun_max_alt, moon_max_alt, roll_duration, stdev_threshold, mw_sb_threshold, testmode, mpsas_high_limit)
-        res = res + result
-        logging.debug(f"location_name {location_name}")
-        logging.debug(f"average_mpsas {average_mpsas:.2f}")
-        logging.debug(f"serial_number {serial_number}")
-        
-        logging.debug(f"making plot")
-        # Path to processed file
-        processed_file = f"/srv/www/d9.pihl.net/public_html/sqm_processing/downloads/{processed_filename}"
-        png_file = f"/srv/www/d9.pihl.net/public_html/sqm_processing/downloads/{processed_filename}.png"
-        randomnumber = random.randint(10, 2000)
-        png_url = f"/sqm_processing/downloads/{processed_filename}.png?{randomnumber}"
-        
-        if testmode > 0:
-            logging.debug(f"testmode {testmode}")
-            processed_file = '/srv/www/d9.pihl.net/public_html/sqm_processing/downloads/processed_20240522_220724_DSMN-2.dat'
-            png_file = f"/srv/www/d9.pihl.net/public_html/sqm_processing/downloads/test.png"
-            png_url = f"/sqm_processing/downloads/test.png?{randomnumber}"
-            
-#out.write("UTC_TIME;;SUN_ALT;MOON_ALT;MPSAS;ROLL_STDEV\n")
-# Load data
-        logging.debug(f"reading data {processed_file}")
-        csv_file = Path(processed_file)
-        
-        
-        
-        try:
-            my_abs_path = csv_file.resolve(strict=True)
-        except FileNotFoundError:
-            logging.debug(f"cant find {csv_file}")
-    # doesn't exist
+        res = f"Received file: {html.escape(filename)}, size={size} bytes\n"
+
+        params = {
+            "mpsas_limit": mpsas_limit,
+            "sun_max_alt": sun_max_alt,
+            "moon_max_alt": moon_max_alt,
+            "roll_duration": roll_duration,
+            "stdev_threshold": stdev_threshold,
+            "mw_sb_threshold": mw_sb_threshold,
+            "mpsas_high_limit": mpsas_high_limit,
+            "output_format": output_format,
+        }
+        cache_key = upload_cache_key(digest, params, testmode)
+        job = cached_result(cache_key) if cache_key else None
+        if job is not None:
+            remove_upload(save_path)
+            logging.info(f"{filename} answered from the result cache")
         else:
-        
-            df = pd.read_csv(processed_file, sep=";", parse_dates=["LOCAL_TIME"])
-            logging.debug(f"has read data {processed_file}")
-# Plot
-
-# scale MOON_ALT to 15–22
-#            df["MOON_ALT_SCALED"] = scale_series(df["MOON_ALT"], mpsas_limit, 22)
-#            df["SUN_ALT_SCALED"] = scale_series(df["SUN_ALT"], mpsas_limit, 22)
-#            df["MW_BRIGHTNESS_SCALED"] = scale_series(df["MW_BRIGHTNESS"], 20, 21)
-
-# x = np.array([1, 2, 3, 4, 5, 6, 7, 8])
-# y = np.array([20, 30, 5, 12, 39, 48, 50, 3])
-
-#            X_Y_Spline = make_interp_spline(df["LOCAL_TIME"], df["MW_BRIGHTNESS_SCALED"])
-#            cubic_interpolation_model = interp1d(df["LOCAL_TIME"], df["MW_BRIGHTNESS_SCALED"], kind = "cubic")
-#            Y_=cubic_interpolation_model(X_)
-#            plt.plot(X_, Y_,label='MW brightness')
-
-# ax1.plot(x, x)
-# ax1.set_yscale('asinh')
-# ax1.grid()
-# ax1.set_title('asinh')
-
-
-            logging.debug(f"has scaled data")
-            plt.figure(figsize=(10, 10))
-#            set_yscale('asinh')
-#             facecolor=dodgerblue
-#             skyblue
-#             gold
-#             orange
-            plt.plot(df["LOCAL_TIME"], df["MPSAS"], marker="o", linestyle="dotted", color="skyblue", label='MPSAS')
-            logging.debug(f"has plotted mpsas data")
-            #plt.plot(df["LOCAL_TIME"], df["MOON_ALT_SCALED"], marker="o", linestyle="none", color="orange", label='Moon alt')
-            #plt.plot(df["LOCAL_TIME"], df["SUN_ALT_SCALED"], marker="o", linestyle="none", color="gold", label='Sun alt')
-            plt.plot(df["LOCAL_TIME"], df["MW_BRIGHTNESS"], marker="o", linestyle="dotted", color="orange", label='MW brightness')
-#             logging.debug(f"has plotted mw data")
-            plt.xlabel("Local Time")
-            plt.ylabel("MPSAS")
-            plt.title(f"SQM MPSAS over time at {location_name}")
-            
-            #scale_to_range(arr, new_min=0, new_max=1):
-            
-            # ({lat}, {lon})
-            #leg = ax.legend(loc="lower left")
-            
-            #plt.legend(["MPSAS", "MOON_ALT", "SUN_ALT"], loc="lower right")
-            
-            plt.grid(True)
-            plt.tight_layout()
-            plt.legend(loc="lower right")
-            
-            logging.debug(f"saving plot {png_file}")
-# Save figure
-            plt.savefig(png_file)
-            plt.close()
-
-
-        download_url = f"/sqm_processing/downloads/{processed_filename}"
-        randomnumber = random.randint(10, 2000)
-        #({lat}, {lon})
-        html_content = f"""
-        <html>
-            <head><title>SQM Processing Result</title></head>
-            <body>
-                
-                <h2>SQM MPSAS processing results for {location_name} </h2>
-                <h4>Average MPSAS for the period: {average_mpsas:.2f}</h4>
-                <strong>Serial number: {serial_number}</strong>
-                <pre>{res}<pre>
-                <p>
-                <img src="{png_url}">
-                </p>
-                <p>File saved as: <strong>{processed_filename}</strong></p>
-                <p><a href="{download_url}" target="_blank">Download processed file</a></p>
-            </body>
-        </html>
-        """
-        return HTMLResponse(content=html_content, status_code=200)
-
-
-      
-#        return {"Hello": "World"}
-#         return PlainTextResponse(
-#             output_io,
-#             status_code=200,
-#             headers={"Content-Type": "text/plain"},
-# #            content={"status": "OK", "detail": str(e), "traceback": tb}
-#             #media_type="text/plain",
-#             #headers={"Content-Type": "text/plain"}
-#         )
-#         
-        
-#         return StreamingResponse(
-#             output_io,
-#             media_type="text/html",
-#             headers={"Content-Type: text/html; charset=utf-8", "Pragma: no-cache"}
-#             #Location: http://www.w3.org/pub/WWW/People.html
-#             #media_type="text/csv",
-#             #headers={"Content-Disposition": f"attachment; filename=processed_{file.filename}"}
-#             
-#     )
-
-        return {"status": "ok", "filename": file.filename, "size_bytes": size, "file: ": save_path}
+            slot_held = False
+            job = await run_in_pool(process_upload, save_path, processed_filename, params, testmode, None, cache_key)
+        res = res + job["result"]
+        return HTMLResponse(content=result_html(job, res), status_code=200)
 
     except Exception as e:
+        # the worker may not have got to the upload (pool broken, worker killed)
+        if save_path is not None:
+            remove_upload(save_path)
         # Return full traceback for debugging
         tb = traceback.format_exc()
         print(tb)
@@ -912,5 +2698,6 @@ async def process_file(
             status_code=500,
             content={"status": "error", "detail": str(e), "traceback": tb}
         )
-
-
+    finally:
+        if slot_held:
+            release_pool_slot()
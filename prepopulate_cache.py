@@ -1,38 +1,40 @@
 #!/usr/bin/env python3
 """
-Prepopulate cache database with astronomical calculations for a year and location.
-This enables instant cache hits when processing files from that location and time period.
+Prepopulate cache database with astronomical calculations for a date range.
+This enables instant cache hits when processing files from that time period.
+
+Only sky_cache is filled: sun and moon positions, the same for every observer, which
+serve all sites in EPHEMERIS_MODE "sky_cache". The service no longer reads the older
+per-location celestial_cache table, so there is nothing to compute per site; --lat, --lon
+and --site from earlier versions are rejected with an error.
+
+The range is split into chunks of --chunk-days, computed as arrays in a process pool and
+written with multi-row inserts. Finished chunks are recorded in a state file, so an
+interrupted run continues where it stopped when started again with the same arguments.
 
 Usage:
-    python3 prepopulate_cache.py --lat 56.04 --lon 10.87 --year 2025
-    python3 prepopulate_cache.py --lat 56.04 --lon 10.87 --year 2025 --month 3
-    python3 prepopulate_cache.py --lat 56.04 --lon 10.87 --start 2025-01-01 --end 2025-12-31
+    python3 prepopulate_cache.py --year 2025
+    python3 prepopulate_cache.py --year 2025 --month 3
+    python3 prepopulate_cache.py --start 2025-01-01 --end 2025-12-31 --workers 8
 """
 
 import argparse
 import sys
+import os
+import json
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime, timedelta
-from astropy.time import Time
-from astropy.coordinates import get_sun, get_body, EarthLocation, AltAz, SkyCoord
-from astropy import units as u
+import numpy as np
 import logging
 
-# Try importing MySQL connector
-try:
-    import mysql.connector
-    from mysql.connector import Error
-except ImportError:
-    print("ERROR: mysql-connector-python not installed")
-    print("Install with: pip install mysql-connector-python")
-    sys.exit(1)
-
 # Import cache functions from main service
 sys.path.insert(0, '/Users/morten/sqm_process2/sqm_processing')
 try:
     from my_sqm_service import (
-        DB_CONFIG, CACHE_TIME_BUCKET_MIN, 
-        round_location, get_time_bucket,
-        BASE_MW_SB_AT_PLANE, PLANE_TO_POLE_FADE, EXTINCTION_COEFF, MW_SB_THRESHOLD
+        CACHE_TIME_BUCKET_MIN, CACHE_ERRORS,
+        init_cache_db, get_cache_backend, compute_sky_positions,
     )
 except ImportError as e:
     print(f"ERROR: Could not import from my_sqm_service: {e}")
@@ -41,165 +43,182 @@ except ImportError as e:
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+DEFAULT_CHUNK_DAYS = 30      # days computed by one worker task, also the resume granularity
+DEFAULT_BATCH_ROWS = 5000    # rows per multi-row insert
+DEFAULT_STATE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "prepopulate_state.json")
 
-def calculate_celestial_values(lat, lon, t):
-    """Calculate sun_alt, moon_alt, mw_brightness, milky_way_visible for a given time."""
-    try:
-        location = EarthLocation(lat=lat*u.deg, lon=lon*u.deg)
-        altaz = AltAz(obstime=t, location=location)
-        
-        # Sun altitude
-        sun_alt = get_sun(t).transform_to(altaz).alt.deg
-        if sun_alt is not None and sun_alt < 0:
-            # Moon altitude (using get_body)
-            moon_alt = get_body("moon", t, location=location).transform_to(altaz).alt.deg
-            
-            # Milky Way brightness calculation
-            zen_altaz = AltAz(obstime=t, location=location, alt=90*u.deg, az=0*u.deg)
-            zenith = SkyCoord(zen_altaz)
-            zenith_gal = zenith.transform_to('galactic')
-            b_deg = abs(zenith_gal.b.deg)
-            
-            mw_sb_plane = BASE_MW_SB_AT_PLANE + (PLANE_TO_POLE_FADE * (b_deg / 90.0))
-            airmass = 1.0
-            mw_sb = mw_sb_plane + EXTINCTION_COEFF * (airmass - 1.0)
-            
-            milky_way_visible = bool(mw_sb <= MW_SB_THRESHOLD)
-            
-            # Convert numpy types to Python types for database compatibility
-            sun_alt = float(sun_alt)
-            moon_alt = float(moon_alt)
-            mw_sb = float(mw_sb)
-            
-            return sun_alt, moon_alt, mw_sb, milky_way_visible
-        else:
-            return None, None, None, None
-    except Exception as e:
-        logger.warning(f"Error calculating values for {t}: {e}")
-        return None, None, None, None
+EPOCH = datetime(1970, 1, 1)
+
+
+def chunk_ranges(start_date, end_date, chunk_days):
+    """(first_second, last_second) unix ranges of the chunks, bucket aligned and inclusive"""
+    step = CACHE_TIME_BUCKET_MIN * 60
+    first = int((start_date - EPOCH).total_seconds() // step) * step
+    last = int((end_date - EPOCH).total_seconds() // step) * step
+    chunk = chunk_days * 86400
+    ranges = []
+    while first <= last:
+        chunk_last = min(first + chunk - step, last)
+        ranges.append((first, chunk_last))
+        first = chunk_last + step
+    return ranges
 
 
-def store_in_cache(lat_rounded, lon_rounded, time_bucket, sun_alt, moon_alt, mw_sb, milky_way_visible):
-    """Store calculated values in cache database."""
+def calculate_chunk(first_second, last_second):
+    """
+    sky_cache rows for every bucket from first_second to last_second (inclusive), computed
+    as arrays. Runs in a worker process.
+    """
+    step = CACHE_TIME_BUCKET_MIN * 60
+    seconds = np.arange(first_second, last_second + 1, step, dtype=float)
+    sky = compute_sky_positions(seconds)
+    return [(EPOCH + timedelta(seconds=int(second)),) + tuple(float(v) for v in sky[:, k])
+            for k, second in enumerate(seconds)]
+
+
+def store_rows(store, rows, batch_rows):
+    """Write rows with one multi-row insert per batch_rows. True when all were stored."""
+    for i in range(0, len(rows), batch_rows):
+        try:
+            if not store(rows[i:i + batch_rows]):
+                logger.error("Cache storage failed: cache database not available")
+                return False
+        except CACHE_ERRORS as e:
+            logger.error(f"Cache storage failed: {e}")
+            return False
+    return True
+
+
+def load_state(path):
+    """Names of the finished chunks recorded in the state file"""
     try:
-        conn = mysql.connector.connect(**DB_CONFIG)
-        cursor = conn.cursor()
-        
-        # Convert datetime to string format for MySQL
-        time_bucket_str = time_bucket.strftime('%Y-%m-%d %H:%M:%S')
-        
-        query = """
-        INSERT INTO celestial_cache (lat, lon, time_bucket, sun_alt, moon_alt, mw_brightness, milky_way_visible)
-        VALUES (%s, %s, %s, %s, %s, %s, %s)
-        ON DUPLICATE KEY UPDATE 
-            sun_alt = VALUES(sun_alt), 
-            moon_alt = VALUES(moon_alt),
-            mw_brightness = VALUES(mw_brightness),
-            milky_way_visible = VALUES(milky_way_visible)
-        """
-        cursor.execute(query, (lat_rounded, lon_rounded, time_bucket_str, sun_alt, moon_alt, mw_sb, milky_way_visible))
-        conn.commit()
-        cursor.close()
-        conn.close()
-        return True
-    except Error as e:
-        logger.error(f"Cache storage failed: {e}")
-        return False
-
-
-def prepopulate(lat, lon, start_date, end_date):
-    """Prepopulate cache for location and date range."""
-    
-    # Round location
-    lat_rounded, lon_rounded = round_location(lat, lon)
-    logger.info(f"Prepopulating cache for location: ({lat_rounded}, {lon_rounded})")
+        with open(path) as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return set()
+    except ValueError as e:
+        logger.warning(f"Ignoring unreadable state file {path}: {e}")
+        return set()
+    if state.get("bucket_min") != CACHE_TIME_BUCKET_MIN:
+        logger.info("State file was written for another bucket size, starting over")
+        return set()
+    return set(state.get("done", []))
+
+
+def save_state(path, done):
+    """Write the state file atomically"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"bucket_min": CACHE_TIME_BUCKET_MIN, "done": sorted(done)}, f)
+    os.replace(tmp_path, path)
+
+
+def prepopulate(start_date, end_date, workers=None, chunk_days=DEFAULT_CHUNK_DAYS,
+                batch_rows=DEFAULT_BATCH_ROWS, state_file=DEFAULT_STATE_FILE, restart=False):
+    """
+    Prepopulate sky_cache for a date range.
+    Returns (total_buckets, stored_rows, failed_chunks).
+    """
+    if not init_cache_db():
+        logger.error("Cache database not available")
+        return 0, 0, 1
+
+    done = set() if restart else load_state(state_file)
+
     logger.info(f"Date range: {start_date.date()} to {end_date.date()}")
-    
-    print(f"Prepopulating cache for location: ({lat_rounded}, {lon_rounded})")
-    print(f"Date range: {start_date.date()} to {end_date.date()}")
 
-    # Generate time buckets
-    current = start_date
-    bucket_seconds = CACHE_TIME_BUCKET_MIN * 60
+    tasks = []
     total_buckets = 0
+    step = CACHE_TIME_BUCKET_MIN * 60
+    for first, last in chunk_ranges(start_date, end_date, chunk_days):
+        # chunk names include both ends, a chunk cut short by an earlier end date is redone
+        name = "/".join((EPOCH + timedelta(seconds=s)).strftime("%Y-%m-%dT%H:%M") for s in (first, last))
+        total_buckets += (last - first) // step + 1
+        if f"sky {name}" not in done:
+            tasks.append((name, first, last))
+    skipped = len(chunk_ranges(start_date, end_date, chunk_days)) - len(tasks)
+    if skipped:
+        logger.info(f"Resuming: {skipped} chunks already done")
+
+    workers = max(1, min(workers or os.cpu_count() or 1, len(tasks) or 1))
+    backend = get_cache_backend()
     stored = 0
-    errors = 0
-    
-    while current <= end_date:
-        # Round to nearest bucket
-        epoch = datetime(1970, 1, 1)
-        diff = (current - epoch).total_seconds()
-        rounded_diff = (diff // bucket_seconds) * bucket_seconds
-        bucket_time = epoch + timedelta(seconds=rounded_diff)
-        
-        # Create astropy Time object
-        t = Time(bucket_time, scale='utc')
-        
-        # Calculate values
-        sun_alt, moon_alt, mw_sb, mw_visible = calculate_celestial_values(lat, lon, t)
-        if sun_alt is not None:
-            print(f"sun_alt: {sun_alt}")
-        else:
-            print("sun_alt: None")  
-        
-        # Only cache when sun is below horizon (sun_alt < 0)
-        if sun_alt is not None and sun_alt < 0:
-            # print(f"store_in_cache lat={lat_rounded}, lon={lon_rounded}, dates {bucket_time} moon_alt: {moon_alt}")
-            if store_in_cache(lat_rounded, lon_rounded, bucket_time, sun_alt, moon_alt, mw_sb, mw_visible):
-                stored += 1
+    failed = 0
+    started = time.time()
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    try:
+        futures = {executor.submit(calculate_chunk, first, last): name for name, first, last in tasks}
+        for n, future in enumerate(as_completed(futures), 1):
+            name = futures[future]
+            try:
+                sky_rows = future.result()
+            except Exception as e:
+                logger.error(f"Chunk {name} failed: {e}")
+                failed += 1
+                continue
+
+            if store_rows(backend.store_sky, sky_rows, batch_rows):
+                stored += len(sky_rows)
+                done.add(f"sky {name}")
+                save_state(state_file, done)
             else:
-                errors += 1
-                print(f"error storing in cache for {bucket_time}")
-        elif sun_alt is not None:
-                # print(f"NOT storing in cache sun_alt = {sun_alt}")
-            # Skip storing when sun is above horizon
-                pass
-        # else:
-        #     errors += 1
-        
-        total_buckets += 1
-        
-        # Log progress every 1000 buckets
-        if total_buckets % 1000 == 0:
-            logger.info(f"Progress: {total_buckets} buckets processed, {stored} stored, {errors} errors")
-        
-        # Move to next bucket
-        current += timedelta(minutes=CACHE_TIME_BUCKET_MIN)
-    
+                failed += 1
+            logger.info(f"Progress: {n}/{len(tasks)} chunks, {stored} rows stored, "
+                        f"{time.time() - started:.0f}s")
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
     logger.info(f"Prepopulation complete!")
     logger.info(f"Total buckets: {total_buckets}")
     logger.info(f"Successfully stored: {stored}")
-    logger.info(f"Errors: {errors}")
-    
-    return total_buckets, stored, errors
+    logger.info(f"Failed chunks: {failed}")
+
+    return total_buckets, stored, failed
 
 
 def main():
     parser = argparse.ArgumentParser(
-        description='Prepopulate cache database for a year/month and location',
+        description='Prepopulate the sun/moon position cache for a year, a month or a date range',
         formatter_class=argparse.RawDescriptionHelpFormatter,
         epilog="""
 Examples:
-  # Prepopulate entire year
-  python3 prepopulate_cache.py --lat 56.04 --lon 10.87 --year 2025
-  
+  # Prepopulate sun/moon positions for all sites, entire year
+  python3 prepopulate_cache.py --year 2025
+
   # Prepopulate specific month
-  python3 prepopulate_cache.py --lat 56.04 --lon 10.87 --year 2025 --month 3
-  
-  # Prepopulate custom date range
-  python3 prepopulate_cache.py --lat 56.04 --lon 10.87 --start 2025-03-01 --end 2025-03-31
+  python3 prepopulate_cache.py --year 2025 --month 3
+
+  # Custom date range, 8 worker processes
+  python3 prepopulate_cache.py --start 2025-03-01 --end 2025-03-31 --workers 8
+
+Interrupted runs continue where they stopped when started again; use --restart to
+recompute everything.
         """
     )
-    
-    parser.add_argument('--lat', type=float, required=True, help='Latitude')
-    parser.add_argument('--lon', type=float, required=True, help='Longitude')
+
+    # the cache is location independent; the old site options are recognized only to fail
+    # with an explanation instead of argparse's "unrecognized arguments"
+    parser.add_argument('--lat', action='append', default=[], help=argparse.SUPPRESS)
+    parser.add_argument('--lon', action='append', default=[], help=argparse.SUPPRESS)
+    parser.add_argument('--site', action='append', default=[], help=argparse.SUPPRESS)
     parser.add_argument('--year', type=int, help='Year to prepopulate (entire year)')
     parser.add_argument('--month', type=int, help='Month (only with --year)')
     parser.add_argument('--start', type=str, help='Start date (YYYY-MM-DD)')
     parser.add_argument('--end', type=str, help='End date (YYYY-MM-DD)')
-    
+    parser.add_argument('--workers', type=int, help='Worker processes (default: number of CPUs)')
+    parser.add_argument('--chunk-days', type=int, default=DEFAULT_CHUNK_DAYS,
+                        help=f'Days per worker task (default: {DEFAULT_CHUNK_DAYS})')
+    parser.add_argument('--batch-rows', type=int, default=DEFAULT_BATCH_ROWS,
+                        help=f'Rows per insert statement (default: {DEFAULT_BATCH_ROWS})')
+    parser.add_argument('--state-file', default=DEFAULT_STATE_FILE, help='Where finished chunks are recorded')
+    parser.add_argument('--restart', action='store_true', help='Ignore the state file and compute everything')
+
     args = parser.parse_args()
-    
+
+    if args.lat or args.lon or args.site:
+        parser.error("--lat, --lon and --site were removed: the sun/moon position cache serves every site, "
+                     "remove them from the command")
+
     # Determine date range
     if args.year:
         if args.month:
@@ -209,6 +228,7 @@ Examples:
                 end_date = datetime(args.year + 1, 1, 1) - timedelta(days=1)
             else:
                 end_date = datetime(args.year, args.month + 1, 1) - timedelta(days=1)
+            end_date = end_date.replace(hour=23, minute=59, second=59)
         else:
             # Entire year
             start_date = datetime(args.year, 1, 1)
@@ -225,16 +245,18 @@ Examples:
         print("Error: Please specify either --year or both --start and --end")
         parser.print_help()
         sys.exit(1)
-    
+
     # Prepopulate
     try:
-        print(f"starting prepopulation for lat={args.lat}, lon={args.lon}, dates {start_date} to {end_date}")
-        total, stored, errors = prepopulate(args.lat, args.lon, start_date, end_date)
-        
-        if errors > 0:
+        print(f"starting prepopulation, dates {start_date} to {end_date}")
+        total, stored, failed = prepopulate(start_date, end_date, workers=args.workers,
+                                            chunk_days=args.chunk_days, batch_rows=args.batch_rows,
+                                            state_file=args.state_file, restart=args.restart)
+
+        if failed > 0:
             sys.exit(1)
     except KeyboardInterrupt:
-        print("\nCancelled by user")
+        print("\nCancelled by user, run again to continue")
         sys.exit(130)
     except Exception as e:
         logger.error(f"Fatal error: {e}")
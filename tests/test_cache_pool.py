@@ -0,0 +1,41 @@
+"""A failing MySQL pool is not asked for connections again within CACHE_RETRY_INTERVAL_S."""
+import time
+
+import pytest
+from mysql.connector import Error
+
+import my_sqm_service
+
+
+class FailingPool:
+    def __init__(self):
+        self.attempts = 0
+
+    def get_connection(self):
+        self.attempts += 1
+        raise Error("Can't connect to MySQL server")
+
+
+@pytest.fixture
+def failing_pool(monkeypatch):
+    pool = FailingPool()
+    monkeypatch.setattr(my_sqm_service, "_cache_pool", pool)
+    monkeypatch.setattr(my_sqm_service, "_cache_pool_failed_at", None)
+    return pool
+
+
+def test_no_second_attempt_within_retry_interval(failing_pool):
+    for _ in range(3):
+        with my_sqm_service.cache_connection() as conn:
+            assert conn is None
+    assert failing_pool.attempts == 1
+
+
+def test_retry_after_interval(failing_pool, monkeypatch):
+    with my_sqm_service.cache_connection() as conn:
+        assert conn is None
+    monkeypatch.setattr(my_sqm_service, "_cache_pool_failed_at",
+                        time.time() - my_sqm_service.CACHE_RETRY_INTERVAL_S - 1)
+    with my_sqm_service.cache_connection() as conn:
+        assert conn is None
+    assert failing_pool.attempts == 2
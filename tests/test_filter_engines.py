@@ -0,0 +1,139 @@
+"""The loop and vectorized filter engines must make the same decisions."""
+import numpy as np
+import pytest
+
+import my_sqm_service
+from my_sqm_service import FILTER_ENGINES, process_stream
+
+STDEV_TOLERANCE = 1e-6
+COUNTERS = ("stop", "used_lines", "milky_way_visible_count", "cloudy_count", "sun_moon_lines_rejected",
+            "count_mw_sb")
+
+
+def synthetic_lines(seed, n=3000):
+    """Kept lines of a few nights: duplicate timestamps, gaps, 3 decimal MPSAS, day/night flips"""
+    rng = np.random.default_rng(seed)
+    steps = rng.choice([0, 60, 60, 60, 60, 61, 300, 3600], size=n)
+    seconds = 1735689600 + np.cumsum(steps)
+
+    # clear stretches with a little noise, cloudy ones with a lot
+    cloudy = np.repeat(rng.random(n // 50 + 1) < 0.3, 50)[:n]
+    noise = np.where(cloudy, rng.normal(0, 0.8, n), rng.normal(0, 0.05, n))
+    mpsas = np.round(20.5 + np.sin(seconds / 20000.0) + noise, 3)
+
+    sun_alts = 40 * np.sin(2 * np.pi * seconds / 86400.0)
+    moon_alts = 30 * np.sin(2 * np.pi * seconds / 89400.0 + 1.0)
+    mw_sbs = np.round(rng.uniform(20.0, 22.0, n), 3)
+    roll_window_s = np.full(n, 15 * 60)
+    return seconds, mpsas, sun_alts, moon_alts, mw_sbs, roll_window_s
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("line_limit", [0, 3, 25, 100000])
+def test_engines_agree(seed, line_limit):
+    lines = synthetic_lines(seed)
+    params = dict(sun_max_alt=-18, moon_max_alt=-5, stdev_threshold=0.3, mw_sb_threshold=20.6,
+                  line_limit=line_limit)
+    loop = FILTER_ENGINES["loop"](*lines, **params)
+    vectorized = FILTER_ENGINES["vectorized"](*lines, **params)
+
+    np.testing.assert_array_equal(vectorized["accepted"], loop["accepted"])
+    for key in COUNTERS:
+        assert vectorized[key] == loop[key], key
+    np.testing.assert_array_equal(vectorized["moon_alt"], loop["moon_alt"])
+    np.testing.assert_array_equal(vectorized["mw_sb"], loop["mw_sb"])
+    np.testing.assert_allclose(vectorized["roll_stdev"], loop["roll_stdev"], rtol=0, atol=STDEV_TOLERANCE)
+    assert vectorized["total_mpsas"] == pytest.approx(loop["total_mpsas"])
+    assert vectorized["max_mpsas"] == loop["max_mpsas"]
+    assert vectorized["total_mw_sb"] == pytest.approx(loop["total_mw_sb"])
+
+
+def test_synthetic_lines_exercise_every_branch():
+    loop = FILTER_ENGINES["loop"](*synthetic_lines(0), sun_max_alt=-18, moon_max_alt=-5,
+                                  stdev_threshold=0.3, mw_sb_threshold=20.6, line_limit=100000)
+    assert loop["used_lines"] > 0
+    assert loop["cloudy_count"] > 0
+    assert loop["sun_moon_lines_rejected"] > 0
+    assert loop["milky_way_visible_count"] > 0
+
+
+def write_dat(path, seed=0, serial="2586", nights=2):
+    """
+    SQM .dat file with one line a minute over a few January nights in Denmark, with
+    unreadable MPSAS values, malformed timestamps and MPSAS above the high limit
+    scattered through it. Returns the line numbers (after the header) of each kind.
+    """
+    header = ["# Light Pollution Monitoring Data Format 1.0\n",
+              "# Position (lat, lon, elev(m)): 55.123, 12.456, 10\n",
+              "# Location name: Test Site\n",
+              f"# SQM serial number: {serial}\n"]
+    header += ["# filler header\n"] * 44
+    header += ["# UTC Date & Time, Local Date & Time, Temperature, Voltage, MSAS, Record type\n",
+               "# END OF HEADER\n"]
+    rng = np.random.default_rng(seed)
+    n = nights * 1440
+    utc = np.datetime64("2024-01-10T12:00:00.000") + np.arange(n) * np.timedelta64(60, "s")
+    local = np.datetime_as_string(utc + np.timedelta64(1, "h"), unit="ms")
+    utc = np.datetime_as_string(utc, unit="ms").astype(object)
+    mpsas = [f"{m:.2f}" for m in 20.5 + np.sin(np.arange(n) / 300.0) + rng.normal(0, 0.03, n)]
+    special = {"unreadable": rng.choice(n, 20, replace=False)}
+    special["bad_time"] = rng.choice(np.setdiff1d(np.arange(n), special["unreadable"]), 20, replace=False)
+    special["high"] = rng.choice(np.setdiff1d(np.arange(n), np.concatenate(list(special.values()))), 20, replace=False)
+    for i in special["unreadable"]:
+        mpsas[i] = "n/a"
+    for i in special["bad_time"]:
+        utc[i] = "2024-01-99T00:00:00.000"
+    for i in special["high"]:
+        mpsas[i] = "23.10"
+    with open(path, "w") as f:
+        f.writelines(header)
+        f.writelines(f"{u};{lt};5.8;4.96;{m};1\n" for u, lt, m in zip(utc, local, mpsas))
+    return {kind: np.sort(index) + 1 for kind, index in special.items()}
+
+
+def compare_filter_engines(file_path, out_dir, mpsas_limit=18, **params):
+    """
+    Process a file with the loop and the vectorized filter engine and compare the results.
+    Returns a list of differences (empty when the report and the CSV output are identical).
+    """
+    results = {}
+    for engine in FILTER_ENGINES:
+        out_path = out_dir / f"{engine}.csv"
+        location_name, average_mpsas, serial_number, report, _ = process_stream(
+            file_path, out_path, mpsas_limit, engine=engine, output_format="csv", **params)
+        results[engine] = (average_mpsas, report.to_text(), out_path.read_text())
+
+    differences = []
+    (avg_loop, report_loop, csv_loop), (avg_vec, report_vec, csv_vec) = results["loop"], results["vectorized"]
+    if avg_loop != avg_vec:
+        differences.append(f"average_mpsas: loop {avg_loop} vectorized {avg_vec}")
+    for name, a, b in (("report", report_loop, report_vec), ("csv", csv_loop, csv_vec)):
+        lines_a, lines_b = a.splitlines(), b.splitlines()
+        if len(lines_a) != len(lines_b):
+            differences.append(f"{name}: loop {len(lines_a)} lines, vectorized {len(lines_b)} lines")
+        for n, (la, lb) in enumerate(zip(lines_a, lines_b)):
+            if la != lb:
+                differences.append(f"{name} line {n + 1}: loop {la!r} vectorized {lb!r}")
+                break
+    return differences
+
+
+@pytest.mark.parametrize("serial", ["2586", "9999"])
+def test_process_stream_engines_agree(tmp_path, monkeypatch, serial):
+    monkeypatch.setattr(my_sqm_service, "LIMIT_SERIALS", 1)   # unregistered serials stop after 99 lines
+    write_dat(tmp_path / "in.dat", serial=serial)
+    assert compare_filter_engines(tmp_path / "in.dat", tmp_path, sun_max_alt=-18, moon_max_alt=-5) == []
+
+
+def test_counters_stop_at_the_line_limit(tmp_path, monkeypatch):
+    monkeypatch.setattr(my_sqm_service, "LIMIT_SERIALS", 1)
+    special = write_dat(tmp_path / "in.dat", serial="9999")
+    report = process_stream(tmp_path / "in.dat", tmp_path / "out.csv", 18, sun_max_alt=-18, moon_max_alt=-5)[3]
+
+    assert report.stopped_early
+    last_line = report.counters["lines_processed"]
+    assert last_line < special["high"][-1]
+    assert report.counters["mpsas_high_rejected"] == int((special["high"] <= last_line).sum())
+    assert report.counters["bad_time_rejected"] == int((special["bad_time"] <= last_line).sum())
+    noted = int((special["unreadable"] <= last_line).sum()) + int((special["bad_time"] <= last_line).sum())
+    assert len(report.events) + report.events_dropped == noted
@@ -0,0 +1,54 @@
+"""Job results whose files were evicted, and expiry of job state files."""
+import os
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+import my_sqm_service
+
+JOB_ID = "0123456789abcdef0123456789abcdef"
+
+
+@pytest.fixture
+def jobs_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(my_sqm_service, "JOBS_DIR", str(tmp_path))
+    return tmp_path
+
+
+def done_job(result_dir):
+    processed = result_dir / "processed_x.dat"
+    return {"job_id": JOB_ID, "status": "done", "phase": "done", "filename": "x.dat", "size_bytes": 1,
+            "result": {"output_format": "csv", "processed_filename": processed.name,
+                       "processed_file": str(processed), "png_file": f"{processed}.png",
+                       "report": {}}}
+
+
+@pytest.mark.parametrize("fmt", ["file", "csv", "png"])
+def test_evicted_result_is_gone(jobs_dir, tmp_path_factory, fmt):
+    my_sqm_service.write_job_status(JOB_ID, done_job(tmp_path_factory.mktemp("results")))
+    response = TestClient(my_sqm_service.app).get(f"/jobs/{JOB_ID}/result", params={"format": fmt})
+    assert response.status_code == 410
+    assert "expired" in response.json()["detail"]
+
+
+def test_stored_result_is_served(jobs_dir, tmp_path_factory):
+    job = done_job(tmp_path_factory.mktemp("results"))
+    with open(job["result"]["processed_file"], "w") as f:
+        f.write("UTC_TIME\n")
+    my_sqm_service.write_job_status(JOB_ID, job)
+    response = TestClient(my_sqm_service.app).get(f"/jobs/{JOB_ID}/result", params={"format": "file"})
+    assert response.status_code == 200
+    assert response.text == "UTC_TIME\n"
+
+
+def test_old_job_status_files_expire(jobs_dir):
+    my_sqm_service.write_job_status(JOB_ID, {"job_id": JOB_ID, "status": "done"})
+    recent = "fedcba9876543210fedcba9876543210"
+    my_sqm_service.write_job_status(recent, {"job_id": recent, "status": "running"})
+    old = time.time() - my_sqm_service.JOB_STATUS_MAX_AGE_S - 60
+    os.utime(my_sqm_service.job_status_path(JOB_ID), (old, old))
+
+    assert my_sqm_service.expire_job_status() == 1
+    assert my_sqm_service.read_job_status(JOB_ID) is None
+    assert my_sqm_service.read_job_status(recent)["status"] == "running"
@@ -0,0 +1,27 @@
+"""compute_zenith_galactic_latitude (closed form) against astropy's AltAz -> galactic transform."""
+import numpy as np
+import pytest
+from astropy import units as u
+from astropy.coordinates import AltAz, EarthLocation, SkyCoord
+from astropy.time import Time
+
+from my_sqm_service import compute_zenith_galactic_latitude
+
+MAX_ERROR_DEG = 0.001
+
+
+def astropy_zenith_galactic_latitude(times, location):
+    """Galactic latitude b (deg) of the zenith, the reference"""
+    n = len(times)
+    zenith = AltAz(obstime=times, location=location, alt=np.full(n, 90.0) * u.deg, az=np.zeros(n) * u.deg)
+    return SkyCoord(zenith).transform_to("galactic").b.deg
+
+
+@pytest.mark.filterwarnings("ignore")
+@pytest.mark.parametrize("site", [(56.04, 10.87), (-33.9, 18.4), (78.2, 15.6), (0.0, -70.0), (-89.9, 0.0)])
+def test_zenith_galactic_latitude_matches_astropy(site):
+    rng = np.random.default_rng(0)
+    times = Time(np.sort(rng.uniform(946684800, 2208988800, 100)), format="unix", scale="utc")  # 2000-2040
+    location = EarthLocation(lat=site[0] * u.deg, lon=site[1] * u.deg)
+    error = np.abs(compute_zenith_galactic_latitude(times, location) - astropy_zenith_galactic_latitude(times, location))
+    assert error.max() < MAX_ERROR_DEG